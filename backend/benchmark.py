@@ -0,0 +1,212 @@
+"""Local benchmark for the survey submit and export paths.
+
+Runs the backend handlers against the App Engine testbed service stubs, so no
+deployment is needed. Generates synthetic surveys for every survey condition,
+submits them through ExperienceSamplingApi in the chosen mode, then exports
+them through the export task chain, and reports throughput and latency.
+
+Needs the App Engine Python SDK. Run from the backend directory:
+    python benchmark.py --sdk ~/google_appengine --surveys 10000 --mode batch
+
+Numbers from the local stubs are much faster than production Datastore and
+Cloud Storage; they are meant for comparing revisions of the code, not for
+capacity planning.
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+import urlparse
+
+package = 'ChromeExperienceSampling'
+
+# Mirrors CONDITIONS in tools/processresults.py, plus the setup survey.
+SURVEY_TYPES = [
+    'setup', 'ssl-overridable-proceed', 'ssl-overridable-noproceed',
+    'ssl-nonoverridable', 'malware-proceed', 'malware-noproceed',
+    'phishing-proceed', 'phishing-noproceed', 'extension-proceed',
+    'extension-noproceed', 'visited-http', 'visited-https']
+ATTRIBUTE_QUESTION = ('To what degree do each of the following adjectives '
+                      'describe this page?(%s)')
+ATTRIBUTES = ['Annoying', 'Confusing', 'Helpful', 'Informative', 'Scary']
+ANSWERS = ['Not at all', 'A little', 'Somewhat', 'Very', 'Extremely']
+QUESTIONS_PER_SURVEY = 8
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _setup_environment(sdk_path):
+  """Puts the SDK and its bundled libraries on sys.path."""
+  if sdk_path:
+    sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  sys.path.insert(0, BACKEND_DIR)
+
+
+def _activate_testbed():
+  from google.appengine.datastore import datastore_stub_util
+  from google.appengine.ext import testbed
+
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_app_identity_stub()
+  bed.init_blobstore_stub()
+  bed.init_datastore_v3_stub(
+      consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+          probability=1))
+  bed.init_memcache_stub()
+  bed.init_taskqueue_stub(root_path=BACKEND_DIR)
+  bed.init_urlfetch_stub()
+  return bed
+
+
+def _make_survey(survey_type, index):
+  from messages import ResponseMessage
+  from messages import SurveyMessage
+
+  responses = [
+      ResponseMessage(question='Question %d for %s' % (i, survey_type),
+                      answer=random.choice(ANSWERS))
+      for i in range(QUESTIONS_PER_SURVEY)]
+  attributes = list(ATTRIBUTES)
+  random.shuffle(attributes)
+  responses.extend(ResponseMessage(question=ATTRIBUTE_QUESTION % a,
+                                   answer=random.choice(ANSWERS))
+                   for a in attributes)
+  return SurveyMessage(
+      survey_type=survey_type + '.js',
+      participant_id='participant%d' % random.randint(0, 999),
+      date_taken=datetime.datetime.utcnow(),
+      responses=responses,
+      submission_id='%032x' % index)
+
+
+def _percentile(sorted_values, fraction):
+  index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+  return sorted_values[index]
+
+
+def _report(name, count, elapsed, latencies):
+  print '%s: %d in %.2fs (%.1f/s)' % (name, count, elapsed, count / elapsed)
+  if latencies:
+    latencies = sorted(latencies)
+    print '  latency ms: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % (
+        _percentile(latencies, 0.5) * 1000,
+        _percentile(latencies, 0.9) * 1000,
+        _percentile(latencies, 0.99) * 1000,
+        latencies[-1] * 1000)
+
+
+def _run_tasks(bed, application, url_prefix):
+  """Runs queued push tasks for url_prefix, including tasks they enqueue."""
+  taskqueue_stub = bed.get_stub('taskqueue')
+  ran = 0
+  while True:
+    tasks = [t for t in taskqueue_stub.get_filtered_tasks(
+                 queue_names=['default'])
+             if t.url.startswith(url_prefix)]
+    if not tasks:
+      return ran
+    for task in tasks:
+      taskqueue_stub.DeleteTask('default', task.name)
+      params = dict(urlparse.parse_qsl(task.payload or ''))
+      response = application.get_response(task.url, method='POST',
+                                           POST=params)
+      if response.status_int != 200:
+        raise RuntimeError('Task %s failed: %s' % (task.url, response.status))
+      ran += 1
+
+
+def benchmark_submit(mode, surveys, batch_size):
+  from google.appengine.ext import ndb
+  import ingest
+  from messages import SurveyBatchMessage
+  import survey_backend_api
+
+  api = survey_backend_api.ExperienceSamplingApi()
+
+  # Each call stands in for one request, including waiting for async writes.
+  @ndb.toplevel
+  def request(method, message):
+    method(message)
+
+  latencies = []
+  start = time.time()
+  if mode == 'batch':
+    for i in range(0, len(surveys), batch_size):
+      message = SurveyBatchMessage(surveys=surveys[i:i + batch_size])
+      t = time.time()
+      request(api.survey_batch_submit, message)
+      latencies.append(time.time() - t)
+  else:
+    survey_backend_api.SUBMIT_MODE = mode
+    for message in surveys:
+      t = time.time()
+      request(api.survey_submit, message)
+      latencies.append(time.time() - t)
+  _report('submit (%s)' % mode, len(surveys), time.time() - start, latencies)
+
+  if mode == 'queue':
+    start = time.time()
+    response = ingest.APPLICATION.get_response('/tasks/ingest')
+    if response.status_int != 200:
+      raise RuntimeError('Ingest failed: %s' % response.status)
+    _report('ingest', len(surveys), time.time() - start, None)
+
+
+def benchmark_export(bed, count, shards, output_format, page_size):
+  import export
+  from models import ExportJob
+
+  filename = 'benchmark.%s' % output_format
+  start = time.time()
+  response = export.APPLICATION.get_response(
+      '/export/worker', method='POST',
+      POST={'filename': filename, 'shards': shards,
+            'format': output_format, 'page_size': page_size})
+  if response.status_int != 200:
+    raise RuntimeError('Export failed: %s' % response.status)
+  tasks = _run_tasks(bed, export.APPLICATION, '/export/')
+  elapsed = time.time() - start
+  # Shards are split at sampled __scatter__ keys, and only a small fraction
+  # of entities have one, so fewer shards than requested may have run.
+  job = ExportJob.query(ExportJob.filename == filename).get()
+  print ('export (%s, %d of %d requested shards, %d split keys found, '
+         'page size %d): %.2fs, %d tasks') % (
+             output_format, job.shard_count, shards, job.shard_count - 1,
+             page_size, elapsed, tasks)
+  print '  %.2fs per 10k surveys' % (elapsed * 10000.0 / count)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--sdk', help='Path to the App Engine Python SDK.')
+  parser.add_argument('--surveys', type=int, default=2000)
+  parser.add_argument('--mode', default='sync',
+                      choices=['sync', 'async', 'queue', 'batch'])
+  parser.add_argument('--batch-size', type=int, default=50)
+  parser.add_argument('--compact', action='store_true',
+                      help='Store responses in the compact encoding.')
+  parser.add_argument('--shards', type=int, default=1)
+  parser.add_argument('--format', default='json', choices=['json', 'ndjson'])
+  parser.add_argument('--page-size', type=int, default=50)
+  args = parser.parse_args()
+
+  _setup_environment(args.sdk)
+  bed = _activate_testbed()
+  try:
+    import models
+    models.COMPACT_RESPONSES = args.compact
+    surveys = [_make_survey(SURVEY_TYPES[i % len(SURVEY_TYPES)], i)
+               for i in range(args.surveys)]
+    benchmark_submit(args.mode, surveys, args.batch_size)
+    benchmark_export(bed, args.surveys, args.shards, args.format,
+                     args.page_size)
+  finally:
+    bed.deactivate()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,213 @@
+"""Sharded counters of received surveys.
+
+Each survey increments one counter for its survey_type and one for the day
+it was received, once it has been stored, by whichever path stored it.
+Increments go to memcache, spread over several shard keys per counter so
+popular counters don't contend on a single key. A cron job periodically
+moves the memcache shards into SurveyCounter entities. Reading a counter
+sums its flushed total and its memcache shards, so it never needs to scan
+surveys.
+
+A new date_received counter starts every day, so neither flushing nor
+reading goes through every counter there is. Flushes only cover the
+survey_type counters and the days that can still have increments in
+memcache, and the counters page reads the counters it is asked for.
+
+Counts that are still in memcache when it is evicted are lost, so the
+counters are meant for dashboards, not for exact accounting.
+"""
+
+import datetime
+import json
+import logging
+import random
+
+from models import SurveyCounter
+import webapp2
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+package = 'ChromeExperienceSampling'
+
+NUM_SHARDS = 20
+MEMCACHE_NAMESPACE = 'counters'
+SURVEY_TYPE_PREFIX = 'survey_type:'
+DATE_RECEIVED_PREFIX = 'date_received:'
+DATE_FORMAT = '%Y-%m-%d'
+# Days flushed by each flush, counting back from today, so increments made
+# just before midnight are still picked up the next day.
+FLUSH_DAYS = 2
+# Days shown by the counters page when it isn't given any counters to show.
+DEFAULT_PAGE_DAYS = 7
+MAX_PAGE_DAYS = 366
+
+# survey_type counters this instance has already made sure exist in the
+# Datastore.
+_registered_names = set()
+
+
+def _shard_keys(name):
+  return ['%s#%d' % (name, shard) for shard in range(NUM_SHARDS)]
+
+
+def counter_names(survey_type, date_received):
+  """Returns the names of the counters a survey is counted in."""
+  return [SURVEY_TYPE_PREFIX + survey_type,
+          DATE_RECEIVED_PREFIX + date_received.strftime(DATE_FORMAT)]
+
+
+def date_counter_names(start, end):
+  """Returns the names of the date_received counters from start to end."""
+  return [DATE_RECEIVED_PREFIX +
+          (start + datetime.timedelta(days=i)).strftime(DATE_FORMAT)
+          for i in range((end - start).days + 1)]
+
+
+def survey_type_counter_names():
+  """Returns the names of the survey_type counters, from the Datastore."""
+  query = SurveyCounter.query(
+      SurveyCounter.key >= ndb.Key(SurveyCounter, SURVEY_TYPE_PREFIX),
+      SurveyCounter.key < ndb.Key(SurveyCounter,
+                                  SURVEY_TYPE_PREFIX[:-1] + ';'))
+  return [key.id() for key in query.fetch(keys_only=True)]
+
+
+def increment(names):
+  """Adds one to each named counter, using one memcache RPC."""
+  offsets = {}
+  for name in names:
+    shard_key = '%s#%d' % (name, random.randint(0, NUM_SHARDS - 1))
+    offsets[shard_key] = offsets.get(shard_key, 0) + 1
+  memcache.offset_multi(offsets, namespace=MEMCACHE_NAMESPACE,
+                        initial_value=0)
+  _register(set(n for n in names if n.startswith(SURVEY_TYPE_PREFIX)) -
+            _registered_names)
+
+
+def _register(names):
+  """Makes sure each named counter has a SurveyCounter entity.
+
+  The flush job finds survey_type counters through their SurveyCounter
+  entities. Every instance registers each counter on its first survey of
+  that type, so existing entities are looked up without a transaction
+  first. Failures are only logged; the survey was already stored, and the
+  name is retried with the next increment.
+  """
+  if not names:
+    return
+  names = list(names)
+  try:
+    counters = ndb.get_multi([ndb.Key(SurveyCounter, n) for n in names])
+    for name, counter in zip(names, counters):
+      if not counter:
+        SurveyCounter.get_or_insert(name)
+      _registered_names.add(name)
+  except Exception as e:
+    logging.warning('Could not register counters %s: %s' % (names, e))
+
+
+def count_surveys(survey_types):
+  """Counts surveys of the given types as received now."""
+  now = datetime.datetime.utcnow()
+  names = []
+  for survey_type in survey_types:
+    names.extend(counter_names(survey_type, now))
+  if names:
+    increment(names)
+
+
+def get_counts(names):
+  """Returns a dict of each named counter to its current count.
+
+  Uses one Datastore and one memcache batch call, whatever the counters.
+  """
+  counters = ndb.get_multi([ndb.Key(SurveyCounter, n) for n in names])
+  shard_keys = []
+  for name in names:
+    shard_keys.extend(_shard_keys(name))
+  pending = memcache.get_multi(shard_keys, namespace=MEMCACHE_NAMESPACE)
+  counts = {}
+  for name, counter in zip(names, counters):
+    counts[name] = (counter.count if counter else 0) + sum(
+        int(pending.get(key, 0)) for key in _shard_keys(name))
+  return counts
+
+
+@ndb.transactional
+def _add_to_counter(name, delta):
+  counter = SurveyCounter.get_by_id(name) or SurveyCounter(id=name)
+  counter.count += delta
+  counter.put()
+
+
+def flush():
+  """Moves counts from memcache shards into SurveyCounter entities.
+
+  Only flushes the survey_type counters and the date_received counters of
+  the last FLUSH_DAYS days, reading all of their shards in one memcache
+  call.
+  """
+  today = datetime.datetime.utcnow()
+  names = survey_type_counter_names() + date_counter_names(
+      today - datetime.timedelta(days=FLUSH_DAYS - 1), today)
+  shard_keys = []
+  for name in names:
+    shard_keys.extend(_shard_keys(name))
+  pending = memcache.get_multi(shard_keys, namespace=MEMCACHE_NAMESPACE)
+  pending = dict((k, int(v)) for k, v in pending.items() if int(v))
+  flushed = {}
+  for name in names:
+    deltas = dict((k, pending[k]) for k in _shard_keys(name) if k in pending)
+    if not deltas:
+      continue
+    _add_to_counter(name, sum(deltas.values()))
+    flushed.update(deltas)
+  # Increments that arrived since the read stay behind for the next flush.
+  if flushed:
+    memcache.offset_multi(dict((k, -v) for k, v in flushed.items()),
+                          namespace=MEMCACHE_NAMESPACE)
+
+
+class CountersPage(webapp2.RequestHandler):
+  """Serves the current value of some counters as JSON.
+
+  Takes any number of counter names as 'name' parameters, and a range of
+  date_received counters as 'start' and 'end' dates (YYYY-MM-DD; end
+  defaults to today). Without either, serves the survey_type counters and
+  the date_received counters of the last DEFAULT_PAGE_DAYS days.
+  """
+
+  def get(self):
+    names = self.request.get_all('name')
+    start = self.request.get('start')
+    end = self.request.get('end')
+    try:
+      end = (datetime.datetime.strptime(end, DATE_FORMAT) if end
+             else datetime.datetime.utcnow())
+      if start:
+        start = datetime.datetime.strptime(start, DATE_FORMAT)
+    except ValueError:
+      self.abort(400, 'Dates must be formatted as YYYY-MM-DD.')
+    if not start and not names:
+      names = survey_type_counter_names()
+      start = end - datetime.timedelta(days=DEFAULT_PAGE_DAYS - 1)
+    if start:
+      if not 0 <= (end - start).days < MAX_PAGE_DAYS:
+        self.abort(400, 'At most %d days can be shown.' % MAX_PAGE_DAYS)
+      names = names + date_counter_names(start, end)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(get_counts(names), indent=2,
+                                   sort_keys=True))
+
+
+class CounterFlushWorker(webapp2.RequestHandler):
+  """Cron worker that flushes memcache counter shards to the Datastore."""
+
+  def get(self):
+    flush()
+
+APPLICATION = webapp2.WSGIApplication([
+    ('/counters', CountersPage),
+    ('/counters/flush', CounterFlushWorker)
+])
@@ -5,10 +5,29 @@ the App Engine Datastore into a file in Cloud Storage, for easy downloading.
 
 Alternately, this can export the data from Datastore into a Spreadsheet in the
 admin's Google Drive.
+
+Exports can be split into shards. Each shard exports one key range of
+SurveyModel into part files from its own chain of tasks, and the parts are
+then composed into the final Cloud Storage object. Every task in a chain
+exports a bounded number of pages and checkpoints its query cursor before
+handing over to the next task, so an export that is interrupted resumes from
+its last checkpoint instead of starting over.
+
+Exports are written either as one JSON array or as newline-delimited JSON,
+optionally gzip-compressed. Compressed part files are independent gzip
+members, so the composed file is still a valid gzip stream.
+
+Incremental exports write only the surveys received since the previous
+incremental export into a delta file, and keep a manifest of delta files.
+Each delta is exported by a single-shard export job, so it is checkpointed
+like any other export, and the watermark only advances once the delta file
+is complete.
 """
 
+import cgi
+import contextlib
 import datetime
-import gc
+import gzip
 import json
 import site
 import time
@@ -16,23 +35,68 @@ import time
 site.addsitedir('lib')
 import cloudstorage as gcs
 
+from models import ExportJob
+from models import ExportShard
+from models import ExportWatermark
 from models import SurveyModel
+import stats
 import webapp2
 
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
 package = 'ChromeExperienceSampling'
 
+BUCKET_NAME = 'survey_responses'
+DEFAULT_PAGE_SIZE = 50
+MAX_EXPORT_SHARDS = 100
+# Number of __scatter__ keys sampled per shard when picking split points.
+SCATTER_OVERSAMPLING = 32
+# Pages each export task writes before checkpointing and re-enqueueing.
+PAGES_PER_TASK = 200
+# Cloud Storage composes at most this many objects per request.
+MAX_COMPOSE_COMPONENTS = 32
+RECORD_DELIMITER = ',\n'
+INCREMENTAL_EXPORT_ID = 'incremental'
+MANIFEST_FILENAME = 'surveys_delta_manifest.json'
+# Global queries are eventually consistent, so incremental exports leave the
+# most recent surveys for the next run rather than risk skipping them.
+INCREMENTAL_EXPORT_LAG = datetime.timedelta(minutes=10)
+RECENT_JOBS_SHOWN = 10
+
 EXPORT_PAGE_HTML = """\
 <html>
   <body>
     <form action='/export' method='post'>
+      <div>Shards: <input type='text' name='shards' value='1'></div>
+      <div>Format:
+        <select name='format'>
+          <option value='json'>JSON array</option>
+          <option value='ndjson'>Newline-delimited JSON</option>
+        </select>
+        <label><input type='checkbox' name='compressed' value='1'>gzip</label>
+      </div>
+      <div>Page size: <input type='text' name='page_size' value='50'></div>
       <div><input type='submit' value='Start Export'></div>
     </form>
+    <form action='/export' method='post'>
+      <input type='hidden' name='incremental' value='1'>
+      <div><input type='submit' value='Export New Surveys'></div>
+    </form>
+    <table>
+      <tr><th>File</th><th>Started</th><th>Shards done</th><th>Records</th>
+          <th>Bytes</th><th>Finished</th></tr>
+%s
+    </table>
   </body>
 </html>
 """
 
+EXPORT_JOB_ROW_HTML = """\
+      <tr><td>%s</td><td>%s</td><td>%d/%d</td><td>%d</td><td>%d</td><td>%s</td>
+      </tr>"""
+
 
 class ModelEncoder(json.JSONEncoder):
   """Some property types don't encode to JSON, so we explicitly handle them."""
@@ -43,15 +107,167 @@ class ModelEncoder(json.JSONEncoder):
     return json.JSONEncoder.default(self, obj)
 
 
+def _gcs_path(filename):
+  return '/' + BUCKET_NAME + '/' + filename
+
+
+def _part_filename(filename, shard, slice_index):
+  return '%s.part%03d-%05d' % (filename, shard, slice_index)
+
+
+@contextlib.contextmanager
+def _open_export_file(filename, compressed=False):
+  """Opens a Cloud Storage file for writing, gzip-compressed if requested."""
+  with gcs.open(_gcs_path(filename), 'w') as f:
+    if compressed:
+      with gzip.GzipFile(filename='', mode='wb', fileobj=f) as gz:
+        yield gz
+    else:
+      yield f
+
+
+def _write_records(f, query, cursor=None, max_pages=None,
+                   page_size=DEFAULT_PAGE_SIZE, ndjson=False, recorder=None):
+  """Appends records matched by query to f, one page at a time.
+
+  Each page is encoded and written in a single write. JSON array records are
+  separated by RECORD_DELIMITER; NDJSON records are each followed by a
+  newline.
+
+  Args:
+    f: File to write to.
+    query: SurveyModel query to export.
+    cursor: Optional query cursor to resume from.
+    max_pages: Stop after this many pages. If None, write every record.
+    page_size: Number of records fetched per page.
+    ndjson: Whether to write newline-delimited JSON.
+    recorder: stats.Recorder for the fetch, encode and write timings. The
+        caller flushes it.
+
+  Returns:
+    A tuple of the number of records written, the number of (uncompressed)
+    bytes written, the cursor to resume from and whether more records remain.
+  """
+  recorder = recorder or stats.Recorder()
+  encoder = ModelEncoder()
+  more = True
+  pages = 0
+  count = 0
+  size = 0
+  while more and (max_pages is None or pages < max_pages):
+    with recorder.timer('export.fetch_page'):
+      records, cursor, more = query.fetch_page(page_size, start_cursor=cursor)
+    pages += 1
+    if not records:
+      continue
+    with recorder.timer('export.encode'):
+      encoded = [encoder.encode(record.to_dict()) for record in records]
+      if ndjson:
+        data = '\n'.join(encoded) + '\n'
+      else:
+        data = RECORD_DELIMITER.join(encoded)
+        if count:
+          data = RECORD_DELIMITER + data
+    start = time.time()
+    f.write(data)
+    recorder.add('export.gcs_write', time.time() - start, len(data))
+    count += len(records)
+    size += len(data)
+  return count, size, cursor, more
+
+
+def _get_split_keys(num_shards):
+  """Picks keys that split SurveyModel into roughly equal key ranges.
+
+  Samples keys in __scatter__ order, which is a random but stable subset of
+  all entities, and takes evenly spaced keys from the sorted sample.
+
+  Returns:
+    A sorted list of at most num_shards - 1 distinct keys.
+  """
+  query = SurveyModel.query().order(ndb.GenericProperty('__scatter__'))
+  sample = sorted(query.fetch(num_shards * SCATTER_OVERSAMPLING,
+                              keys_only=True))
+  if not sample:
+    return []
+  stride = len(sample) / float(num_shards)
+  split_keys = []
+  for i in range(1, num_shards):
+    key = sample[int(i * stride)]
+    if not split_keys or split_keys[-1] != key:
+      split_keys.append(key)
+  return split_keys
+
+
+def _add_named_task(name, **kwargs):
+  """Adds a task unless one with the same name was already added."""
+  try:
+    taskqueue.add(name=name, **kwargs)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _delete_if_exists(filename):
+  """Deletes a Cloud Storage file that an earlier attempt may have deleted."""
+  try:
+    gcs.delete(_gcs_path(filename))
+  except gcs.NotFoundError:
+    pass
+
+
+def _compose(components, filename):
+  """Composes objects into filename, in rounds if there are too many.
+
+  An export has 2 * parts + 1 components in JSON array format, which is more
+  than MAX_COMPOSE_COMPONENTS once there are 16 or more parts, so the
+  components are composed in groups first.
+  """
+  intermediates = []
+  while len(components) > MAX_COMPOSE_COMPONENTS:
+    next_round = []
+    for i in range(0, len(components), MAX_COMPOSE_COMPONENTS):
+      name = '%s.compose%04d' % (filename, len(intermediates))
+      gcs.compose(components[i:i + MAX_COMPOSE_COMPONENTS], _gcs_path(name))
+      intermediates.append(name)
+      next_round.append(name)
+    components = next_round
+  gcs.compose(components, _gcs_path(filename))
+  for name in intermediates:
+    gcs.delete(_gcs_path(name))
+
+
 class ExportPage(webapp2.RequestHandler):
-  """Serves a form to add a taskqueue job to export data."""
+  """Serves a form to add a taskqueue job to export data.
+
+  Also shows the progress of the most recent exports.
+  """
 
   def get(self):
-    self.response.write(EXPORT_PAGE_HTML)
+    jobs = ExportJob.query().order(-ExportJob.date_started).fetch(
+        RECENT_JOBS_SHOWN)
+    rows = []
+    for job in jobs:
+      shards = ndb.get_multi([ExportShard.keyFor(job.key, i)
+                              for i in range(job.shard_count)])
+      shards = [s for s in shards if s]
+      rows.append(EXPORT_JOB_ROW_HTML % (
+          cgi.escape(job.filename), job.date_started,
+          len(job.completed_shards), job.shard_count,
+          sum(s.records_written for s in shards),
+          sum(s.bytes_written for s in shards),
+          job.date_finished or ''))
+    self.response.write(EXPORT_PAGE_HTML % '\n'.join(rows))
 
   def post(self):
-    taskqueue.add(url='/export/worker',
-                  params={'filename': self.request.get('filename')})
+    if self.request.get('incremental'):
+      taskqueue.add(url='/export/incremental')
+    else:
+      taskqueue.add(url='/export/worker',
+                    params={'filename': self.request.get('filename'),
+                            'shards': self.request.get('shards'),
+                            'format': self.request.get('format'),
+                            'compressed': self.request.get('compressed'),
+                            'page_size': self.request.get('page_size')})
     self.redirect('/export')
 
 
@@ -60,38 +276,282 @@ class ExportWorker(webapp2.RequestHandler):
 
   Can optionally take in a filename to use for the file in Cloud Storage.
   If not specified, it will use a default name plus the date and time.
-  Repeatedly queries for more SurveyModel items from the Datastore, appending
-  them one at a time to the export file in order to minimize memory usage.
+  Can also take a number of shards; the SurveyModel keyspace is split into
+  that many key ranges, and each range is exported by its own chain of
+  ExportShardWorker tasks. The output format ('json' or 'ndjson'), gzip
+  compression and the number of records fetched per page are also optional.
   """
 
   def post(self):
-    bucket_name = 'survey_responses'
+    output_format = self.request.get('format') or 'json'
+    compressed = bool(self.request.get('compressed'))
+    page_size = int(self.request.get('page_size') or DEFAULT_PAGE_SIZE)
     filename = self.request.get('filename')
     if not filename:
       time_string = time.strftime('%Y_%m_%d_%H%M%S_%Z')
-      filename = '.'.join(['surveys', time_string, 'json'])
-
-    def export_data(filename):
-      with gcs.open('/' + bucket_name + '/' + filename, 'w') as f:
-        query = SurveyModel.query()
-        cursor = None
-        more = True
-        delim = ''
-        f.write('[')
-        while more:
-          records, cursor, more = query.fetch_page(50, start_cursor=cursor)
-          gc.collect()
-          for record in records:
-            f.write(delim)
-            f.write(json.dumps(record.to_dict(), cls=ModelEncoder))
-            delim = ',\n'
-        f.write(']')
-
-    export_data(filename)
+      parts = ['surveys', time_string, output_format]
+      if compressed:
+        parts.append('gz')
+      filename = '.'.join(parts)
+    shards = min(int(self.request.get('shards') or 1), MAX_EXPORT_SHARDS)
+
+    # The job is keyed on the task name, so a retry of this task picks up the
+    # job it already created instead of starting a second export.
+    task_name = self.request.headers.get('X-AppEngine-TaskName')
+    if task_name:
+      job_key = ndb.Key(ExportJob, task_name)
+    else:
+      job_key = ndb.Key(ExportJob, ExportJob.allocate_ids(1)[0])
+    job = job_key.get()
+    if job:
+      states = ndb.get_multi([ExportShard.keyFor(job.key, i)
+                              for i in range(job.shard_count)])
+    else:
+      split_keys = _get_split_keys(shards) if shards > 1 else []
+      boundaries = [None] + split_keys + [None]
+      job = ExportJob(key=job_key, filename=filename,
+                      output_format=output_format, compressed=compressed,
+                      page_size=page_size, shard_count=len(boundaries) - 1)
+      states = [ExportShard(key=ExportShard.keyFor(job.key, i),
+                            job=job.key, shard=i,
+                            start_key=boundaries[i],
+                            end_key=boundaries[i + 1])
+                for i in range(job.shard_count)]
+      # Shards first, so an existing job always has all of its shards.
+      ndb.put_multi(states)
+      job.put()
+    for state in states:
+      _add_named_task('%s-0' % state.key.id(), url='/export/shard',
+                      params={'state': state.key.urlsafe(), 'slice': 0})
+
+
+class ExportShardWorker(webapp2.RequestHandler):
+  """Taskqueue worker that exports one slice of a shard into a part file.
+
+  Part files hold delimited records without the enclosing brackets. After
+  writing its part, the task checkpoints the shard's cursor and enqueues the
+  next slice in the same transaction. Retried tasks rewrite their own part
+  file, and tasks for slices that were already checkpointed do nothing. The
+  last shard to finish schedules ExportComposeWorker.
+  """
+
+  def post(self):
+    state_key = ndb.Key(urlsafe=self.request.get('state'))
+    slice_index = int(self.request.get('slice'))
+    state = state_key.get()
+
+    if state.slices == slice_index and not state.done:
+      job = state.job.get()
+      query = self.shard_query(job, state)
+      cursor = Cursor(urlsafe=state.cursor) if state.cursor else None
+
+      part = _part_filename(job.filename, state.shard, slice_index)
+      recorder = stats.Recorder()
+      with _open_export_file(part, job.compressed) as f:
+        count, size, cursor, more = _write_records(
+            f, query, cursor=cursor, max_pages=PAGES_PER_TASK,
+            page_size=job.page_size, ndjson=job.output_format == 'ndjson',
+            recorder=recorder)
+      recorder.flush()
+      state = self.checkpoint(state_key, slice_index, count, size, cursor,
+                              more)
+
+    if state.done:
+      self.finish_shard(state.job, state.shard)
+
+  @staticmethod
+  def shard_query(job, state):
+    if job.date_received_until:
+      query = SurveyModel.query(
+          SurveyModel.date_received <= job.date_received_until)
+      if job.date_received_after:
+        query = query.filter(
+            SurveyModel.date_received > job.date_received_after)
+      return query.order(SurveyModel.date_received)
+    query = SurveyModel.query()
+    if state.start_key:
+      query = query.filter(SurveyModel.key >= state.start_key)
+    if state.end_key:
+      query = query.filter(SurveyModel.key < state.end_key)
+    return query
+
+  @staticmethod
+  @ndb.transactional
+  def checkpoint(state_key, slice_index, count, size, cursor, more):
+    state = state_key.get()
+    if state.slices != slice_index:
+      return state
+    state.slices += 1
+    if count:
+      state.nonempty_slices.append(slice_index)
+    state.records_written += count
+    state.bytes_written += size
+    state.cursor = cursor.urlsafe() if cursor else None
+    state.done = not more
+    state.put()
+    if more:
+      taskqueue.add(url='/export/shard',
+                    params={'state': state_key.urlsafe(),
+                            'slice': slice_index + 1},
+                    transactional=True)
+    return state
+
+  @staticmethod
+  @ndb.transactional
+  def finish_shard(job_key, shard):
+    job = job_key.get()
+    # Task retries can finish a shard twice; only count it once.
+    if shard in job.completed_shards:
+      return
+    job.completed_shards.append(shard)
+    job.put()
+    if len(job.completed_shards) == job.shard_count:
+      taskqueue.add(url='/export/compose',
+                    params={'job': job_key.urlsafe()},
+                    transactional=True)
+
+
+class ExportComposeWorker(webapp2.RequestHandler):
+  """Taskqueue worker that composes shard part files into the export file."""
+
+  def post(self):
+    job = ndb.Key(urlsafe=self.request.get('job')).get()
+    states = ndb.get_multi([ExportShard.keyFor(job.key, i)
+                            for i in range(job.shard_count)])
+    if not job.date_finished:
+      self.compose(job, states)
+      job = self.finish(job.key, sum(s.records_written for s in states))
+
+    # Parts are only deleted once the job is marked finished, so a retry never
+    # composes parts that are gone. A retry after a partial cleanup finishes
+    # deleting what is left.
+    for name in ['head', 'delim', 'tail']:
+      _delete_if_exists('%s.%s' % (job.filename, name))
+    for state in states:
+      for slice_index in range(state.slices):
+        _delete_if_exists(
+            _part_filename(job.filename, state.shard, slice_index))
+
+    if job.date_received_until:
+      # Written on every attempt, so a retry still publishes the manifest.
+      state = ExportWatermark.get_by_id(INCREMENTAL_EXPORT_ID)
+      with gcs.open(_gcs_path(MANIFEST_FILENAME), 'w',
+                    content_type='application/json') as f:
+        f.write(json.dumps(state.manifest, indent=2))
+
+  @staticmethod
+  def compose(job, states):
+    parts = [_part_filename(job.filename, state.shard, slice_index)
+             for state in states
+             for slice_index in sorted(state.nonempty_slices)]
+
+    if job.output_format == 'ndjson':
+      # NDJSON parts already end in a newline and just need concatenating.
+      pieces = {}
+      components = parts
+    else:
+      # Brackets and delimiters are stored as tiny objects so the whole export
+      # can be assembled by Cloud Storage without downloading any part.
+      pieces = {'head': '[', 'delim': RECORD_DELIMITER, 'tail': ']'}
+      components = [job.filename + '.head']
+      for i, part in enumerate(parts):
+        if i:
+          components.append(job.filename + '.delim')
+        components.append(part)
+      components.append(job.filename + '.tail')
+    for name, content in pieces.items():
+      with _open_export_file('%s.%s' % (job.filename, name),
+                             job.compressed) as f:
+        f.write(content)
+
+    if components:
+      _compose(components, job.filename)
+    else:
+      with _open_export_file(job.filename, job.compressed):
+        pass
+
+  @staticmethod
+  @ndb.transactional(xg=True)
+  def finish(job_key, records):
+    job = job_key.get()
+    if not job.date_finished:
+      job.date_finished = datetime.datetime.utcnow()
+      job.put()
+      if job.date_received_until:
+        ExportIncrementalWorker.advance_watermark(job, records)
+    return job
+
+
+class ExportIncrementalWorker(webapp2.RequestHandler):
+  """Exports surveys received since the last incremental export.
+
+  Starts a single-shard ExportJob that writes them to a delta file in Cloud
+  Storage. When the job finishes, ExportComposeWorker advances the watermark
+  and adds the delta file to the manifest, which is also written to Cloud
+  Storage so downstream processing can find the deltas. Only one delta is
+  exported at a time. Runs from cron (GET) or as a task queued from the
+  export page (POST).
+  """
+
+  def get(self):
+    self.export_delta()
+
+  def post(self):
+    self.export_delta()
+
+  def export_delta(self):
+    state = ExportWatermark.get_or_insert(INCREMENTAL_EXPORT_ID)
+    if state.pending_job:
+      return
+    until = datetime.datetime.utcnow() - INCREMENTAL_EXPORT_LAG
+    time_string = until.strftime('%Y_%m_%d_%H%M%S')
+    filename = '.'.join(['surveys_delta', time_string, 'json'])
+    self.start_delta(state.watermark, until, filename)
+
+  @staticmethod
+  @ndb.transactional(xg=True)
+  def start_delta(since, until, filename):
+    """Starts the export job for a delta, unless another run already did."""
+    state = ExportWatermark.get_by_id(INCREMENTAL_EXPORT_ID)
+    if state.pending_job or state.watermark != since:
+      return
+    job = ExportJob(filename=filename, page_size=DEFAULT_PAGE_SIZE,
+                    shard_count=1, date_received_after=since,
+                    date_received_until=until)
+    job.put()
+    shard = ExportShard(key=ExportShard.keyFor(job.key, 0), job=job.key,
+                        shard=0)
+    shard.put()
+    state.pending_job = job.key
+    state.put()
+    taskqueue.add(url='/export/shard',
+                  params={'state': shard.key.urlsafe(), 'slice': 0},
+                  transactional=True)
+
+  @staticmethod
+  def advance_watermark(job, records):
+    """Records the delta file of a finished job and advances the watermark.
+
+    Must be called in a transaction.
+    """
+    state = ExportWatermark.get_by_id(INCREMENTAL_EXPORT_ID)
+    if state.pending_job != job.key:
+      return
+    since = job.date_received_after
+    entry = {'filename': job.filename,
+             'date_received_after': since.isoformat() if since else None,
+             'date_received_until': job.date_received_until.isoformat(),
+             'records': records}
+    state.watermark = job.date_received_until
+    state.manifest = state.manifest + [entry]
+    state.pending_job = None
+    state.put()
 
 APPLICATION = webapp2.WSGIApplication([
     ('/export/', ExportPage),
     ('/export', ExportPage),
-    ('/export/worker', ExportWorker)
+    ('/export/worker', ExportWorker),
+    ('/export/shard', ExportShardWorker),
+    ('/export/compose', ExportComposeWorker),
+    ('/export/incremental', ExportIncrementalWorker)
 ])
-
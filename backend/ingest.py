@@ -0,0 +1,170 @@
+"""Task queue workers for survey ingestion.
+
+These handlers store surveys that were not written while the submitting
+request was being served: either because the write failed, or because the
+survey was buffered in the ingest pull queue to be committed in bulk.
+
+Also has the duplicate check for surveys submitted with a submission ID,
+which every write path uses.
+"""
+
+import logging
+import re
+import time
+
+from protorpc import protojson
+
+import counters
+from messages import SurveyMessage
+from models import SurveyModel
+import stats
+import webapp2
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+package = 'ChromeExperienceSampling'
+
+INGEST_QUEUE_NAME = 'survey-ingest'
+# Pull queue leases are capped at 1000 tasks per call.
+LEASE_BATCH_SIZE = 1000
+LEASE_SECONDS = 120
+# Stop leasing new batches after this long, well inside the cron deadline.
+MAX_INGEST_SECONDS = 300
+SUBMISSION_NAMESPACE = 'submissions'
+# Extension retries back off exponentially, but give up well within a week.
+SUBMISSION_CACHE_SECONDS = 7 * 24 * 60 * 60
+# Submission IDs are used as key names, so only the 32 hex digits the
+# extension generates are accepted.
+SUBMISSION_ID_RE = re.compile(r'[0-9a-f]{32}\Z')
+
+
+def is_valid_submission_id(submission_id):
+  """Returns whether a submission ID, which may be None, can be stored."""
+  return submission_id is None or bool(SUBMISSION_ID_RE.match(submission_id))
+
+
+def check_new_submissions(messages):
+  """Finds which SurveyMessages still need to be stored.
+
+  Submission IDs recorded in memcache are known duplicates without touching
+  the Datastore; the remaining IDs are looked up by key. Messages without a
+  submission ID are always new.
+
+  Returns:
+    A list with one boolean per message, True if it should be stored.
+  """
+  ids = list(set(m.submission_id for m in messages if m.submission_id))
+  stored = set()
+  if ids:
+    stored.update(memcache.get_multi(ids, namespace=SUBMISSION_NAMESPACE))
+    unknown = [i for i in ids if i not in stored]
+    surveys = ndb.get_multi([ndb.Key(SurveyModel, i) for i in unknown])
+    found = [i for i, survey in zip(unknown, surveys) if survey]
+    remember_submissions(found)
+    stored.update(found)
+
+  is_new = []
+  for message in messages:
+    if message.submission_id:
+      is_new.append(message.submission_id not in stored)
+      # Only the first copy of an ID within one batch is new.
+      stored.add(message.submission_id)
+    else:
+      is_new.append(True)
+  return is_new
+
+
+def remember_submissions(submission_ids):
+  """Records stored submission IDs so retries are rejected from memcache."""
+  ids = [i for i in submission_ids if i]
+  if ids:
+    memcache.set_multi(dict.fromkeys(ids, 1), time=SUBMISSION_CACHE_SECONDS,
+                       namespace=SUBMISSION_NAMESPACE)
+
+
+def enqueue_survey(message):
+  """Buffers a SurveyMessage in the ingest pull queue."""
+  task = taskqueue.Task(payload=protojson.encode_message(message),
+                        method='PULL')
+  taskqueue.Queue(INGEST_QUEUE_NAME).add(task)
+
+
+class RetrySurveyWorker(webapp2.RequestHandler):
+  """Push task worker that retries a failed survey write.
+
+  The task payload is a protojson-encoded SurveyMessage. Any exception fails
+  the task, so the task queue keeps retrying it with backoff.
+  """
+
+  def post(self):
+    message = protojson.decode_message(SurveyMessage, self.request.body)
+    if check_new_submissions([message])[0]:
+      SurveyModel.fromMessage(message).put()
+      remember_submissions([message.submission_id])
+      counters.count_surveys([message.survey_type])
+
+
+class IngestWorker(webapp2.RequestHandler):
+  """Cron worker that drains the ingest pull queue into the Datastore.
+
+  Leases buffered surveys in large batches, converts them to SurveyModel
+  entities and commits each batch with a single put_multi. Tasks are deleted
+  only after their batch is committed; if the write fails, the leases expire
+  and the surveys are picked up again by a later run. Surveys that could
+  never be stored are logged and dropped, so they don't hold back the rest
+  of their batch.
+  """
+
+  def get(self):
+    queue = taskqueue.Queue(INGEST_QUEUE_NAME)
+    deadline = time.time() + MAX_INGEST_SECONDS
+    recorder = stats.Recorder()
+    while time.time() < deadline:
+      tasks = queue.lease_tasks(LEASE_SECONDS, LEASE_BATCH_SIZE)
+      if not tasks:
+        break
+      messages = []
+      with recorder.timer('ingest.decode'):
+        for task in tasks:
+          try:
+            message = protojson.decode_message(SurveyMessage, task.payload)
+            if not is_valid_submission_id(message.submission_id):
+              raise ValueError('Invalid submission_id %r'
+                               % message.submission_id)
+          except Exception as e:
+            # Retrying a payload that can't be decoded will never succeed, so
+            # it is logged and dropped along with the rest of the batch.
+            logging.error('Discarding undecodable survey task %s: %s'
+                          % (task.name, e))
+            continue
+          messages.append((task, message))
+      is_new = check_new_submissions([m for _, m in messages])
+      surveys = []
+      stored = []
+      for (task, message), new in zip(messages, is_new):
+        if not new:
+          continue
+        # Likewise for a survey that can't be converted, which would
+        # otherwise fail the put_multi for the whole batch on every retry.
+        try:
+          surveys.append(SurveyModel.fromMessage(message))
+        except Exception as e:
+          logging.error('Discarding unstorable survey task %s: %s'
+                        % (task.name, e))
+          continue
+        stored.append(message)
+      with recorder.timer('ingest.put_multi'):
+        ndb.put_multi(surveys)
+      remember_submissions([m.submission_id for m in stored])
+      counters.count_surveys([m.survey_type for m in stored])
+      queue.delete_tasks(tasks)
+      if len(tasks) < LEASE_BATCH_SIZE:
+        break
+    recorder.flush()
+
+APPLICATION = webapp2.WSGIApplication([
+    ('/tasks/retrysurvey', RetrySurveyWorker),
+    ('/tasks/ingest', IngestWorker)
+])
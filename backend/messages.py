@@ -19,4 +19,32 @@ class SurveyMessage(messages.Message):
   participant_id = messages.StringField(2, required=True)
   date_taken = message_types.DateTimeField(3, required=True)
   responses = messages.MessageField(ResponseMessage, 4, repeated=True)
+  # Optional client-generated ID, reused when a submission is retried.
+  submission_id = messages.StringField(5)
 
+
+class SurveyBatchMessage(messages.Message):
+  surveys = messages.MessageField(SurveyMessage, 1, repeated=True)
+
+
+class SubmitResultMessage(messages.Message):
+  success = messages.BooleanField(1, required=True)
+  error = messages.StringField(2)
+
+
+class SurveyBatchResultMessage(messages.Message):
+  results = messages.MessageField(SubmitResultMessage, 1, repeated=True)
+
+
+class SurveyQueryMessage(messages.Message):
+  participant_id = messages.StringField(1)
+  survey_type = messages.StringField(2)
+  page_size = messages.IntegerField(3, variant=messages.Variant.INT32,
+                                    default=20)
+  cursor = messages.StringField(4)
+
+
+class SurveyListMessage(messages.Message):
+  surveys = messages.MessageField(SurveyMessage, 1, repeated=True)
+  next_cursor = messages.StringField(2)
+  more = messages.BooleanField(3)
@@ -1,12 +1,38 @@
 """AppEngine Datastore models for the Chrome Experience Sampling backend.
 
-These classes define the data models for form and survey responses.
+These classes define the data models for form and survey responses, plus the
+bookkeeping models used while exporting them.
+
+Survey responses can be stored compactly: the question texts, which repeat
+across almost every survey, are stored once each as QuestionModel entities,
+and each survey only keeps a compressed list of (question ID, answer) pairs.
+Surveys stored either way read back the same through getResponses and
+to_dict.
 """
 
+import datetime
+import hashlib
+
+from messages import ResponseMessage
+from messages import SurveyMessage
+
 from google.appengine.ext import ndb
 
 package = 'ChromeExperienceSampling'
 
+# Whether new surveys store their responses in the compact encoding.
+COMPACT_RESPONSES = False
+
+# Question texts already known to exist in the Datastore, by question ID.
+_question_texts = {}
+
+
+def _parseDatetime(value):
+  """Parses the isoformat() timestamps written by the exporter."""
+  if '.' in value:
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+  return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
 
 class ResponseModel(ndb.Model):
   question = ndb.TextProperty()
@@ -18,17 +44,167 @@ class ResponseModel(ndb.Model):
                          answer=message.answer)
 
 
+class QuestionModel(ndb.Model):
+  """Question dictionary entry; the entity ID is derived from the text."""
+  text = ndb.TextProperty(required=True)
+
+  @staticmethod
+  def idFor(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+  @staticmethod
+  def intern(texts):
+    """Makes sure every question text is in the dictionary.
+
+    Returns:
+      The list of question IDs for texts, in the same order.
+    """
+    ids = [QuestionModel.idFor(text) for text in texts]
+    missing = dict((i, t) for i, t in zip(ids, texts)
+                   if i not in _question_texts)
+    if missing:
+      keys = [ndb.Key(QuestionModel, i) for i in missing]
+      found = ndb.get_multi(keys)
+      ndb.put_multi([QuestionModel(key=k, text=missing[k.id()])
+                     for k, q in zip(keys, found) if q is None])
+      _question_texts.update(missing)
+    return ids
+
+  @staticmethod
+  def textsFor(ids):
+    """Looks up the question texts for a list of question IDs."""
+    missing = list(set(i for i in ids if i not in _question_texts))
+    if missing:
+      questions = ndb.get_multi([ndb.Key(QuestionModel, i) for i in missing])
+      for i, q in zip(missing, questions):
+        _question_texts[i] = q.text
+    return [_question_texts[i] for i in ids]
+
+
 class SurveyModel(ndb.Model):
   survey_type = ndb.StringProperty(indexed=True, required=True)
   participant_id = ndb.StringProperty(indexed=True, required=True)
   date_taken = ndb.DateTimeProperty(required=True)
   date_received = ndb.DateTimeProperty(auto_now_add=True)
   responses = ndb.StructuredProperty(ResponseModel, repeated=True)
+  # Compact encoding of responses as [[question_id, answer], ...]. When set,
+  # responses is left empty.
+  packed_responses = ndb.JsonProperty(compressed=True)
 
   @staticmethod
   def fromMessage(message):
-    return SurveyModel(survey_type=message.survey_type,
-                       participant_id=message.participant_id,
-                       date_taken=message.date_taken,
-                       responses=map(ResponseModel.fromMessage,
-                                     message.responses))
+    # Surveys with a submission ID use it as their key, so a retried
+    # submission overwrites the same entity instead of adding a new one.
+    survey = SurveyModel(id=message.submission_id,
+                         survey_type=message.survey_type,
+                         participant_id=message.participant_id,
+                         date_taken=message.date_taken)
+    survey.setResponses([(r.question, r.answer) for r in message.responses])
+    return survey
+
+  @staticmethod
+  def fromDict(data, id=None):
+    """Builds a survey from a dict in the format written by the exporter."""
+    survey = SurveyModel(id=id,
+                         survey_type=data['survey_type'],
+                         participant_id=data['participant_id'],
+                         date_taken=_parseDatetime(data['date_taken']))
+    if data.get('date_received'):
+      survey.date_received = _parseDatetime(data['date_received'])
+    survey.setResponses([(r['question'], r['answer'])
+                         for r in data['responses']])
+    return survey
+
+  def setResponses(self, pairs):
+    """Sets the responses from (question, answer) pairs."""
+    if COMPACT_RESPONSES:
+      ids = QuestionModel.intern([question for question, _ in pairs])
+      self.packed_responses = [
+          [i, answer] for i, (_, answer) in zip(ids, pairs)]
+    else:
+      self.responses = [ResponseModel(question=question, answer=answer)
+                        for question, answer in pairs]
+
+  def toMessage(self):
+    return SurveyMessage(
+        survey_type=self.survey_type,
+        participant_id=self.participant_id,
+        date_taken=self.date_taken,
+        responses=[ResponseMessage(question=r.question, answer=r.answer)
+                   for r in self.getResponses()],
+        submission_id=self.key.string_id() if self.key else None)
+
+  def getResponses(self):
+    """Returns the responses as ResponseModels, however they were stored."""
+    if self.packed_responses is None:
+      return self.responses
+    texts = QuestionModel.textsFor([i for i, _ in self.packed_responses])
+    return [ResponseModel(question=text, answer=answer)
+            for text, (_, answer) in zip(texts, self.packed_responses)]
+
+  def to_dict(self, include=None, exclude=None):
+    exclude = list(exclude or []) + ['packed_responses']
+    result = super(SurveyModel, self).to_dict(include=include, exclude=exclude)
+    if 'responses' in result:
+      result['responses'] = [r.to_dict() for r in self.getResponses()]
+    return result
+
+
+class ExportJob(ndb.Model):
+  """Bookkeeping for an export split across several task queue tasks."""
+  filename = ndb.StringProperty(required=True)
+  # 'json' writes one JSON array; 'ndjson' writes one JSON record per line.
+  output_format = ndb.StringProperty(choices=['json', 'ndjson'],
+                                     default='json')
+  compressed = ndb.BooleanProperty(default=False)
+  page_size = ndb.IntegerProperty(required=True)
+  shard_count = ndb.IntegerProperty(required=True)
+  completed_shards = ndb.IntegerProperty(repeated=True)
+  date_started = ndb.DateTimeProperty(auto_now_add=True)
+  date_finished = ndb.DateTimeProperty()
+  # Set for incremental exports, which only export surveys received in
+  # (date_received_after, date_received_until].
+  date_received_after = ndb.DateTimeProperty(indexed=False)
+  date_received_until = ndb.DateTimeProperty(indexed=False)
+
+
+class ExportShard(ndb.Model):
+  """Checkpoint for one key range of an ExportJob.
+
+  Each slice of the shard is exported by its own task into its own part file.
+  After a slice is written, the query cursor and totals are saved here so the
+  next slice resumes where it left off.
+  """
+  job = ndb.KeyProperty(kind=ExportJob, required=True)
+  shard = ndb.IntegerProperty(required=True)
+  start_key = ndb.KeyProperty(indexed=False)
+  end_key = ndb.KeyProperty(indexed=False)
+  cursor = ndb.StringProperty(indexed=False)
+  slices = ndb.IntegerProperty(default=0)
+  # Slices whose part file holds at least one record.
+  nonempty_slices = ndb.IntegerProperty(repeated=True)
+  records_written = ndb.IntegerProperty(default=0)
+  bytes_written = ndb.IntegerProperty(default=0)
+  done = ndb.BooleanProperty(default=False)
+
+  @staticmethod
+  def keyFor(job_key, shard):
+    # Kept out of the job's entity group so shards checkpoint independently.
+    return ndb.Key(ExportShard, '%s-%d' % (job_key.id(), shard))
+
+
+class ExportWatermark(ndb.Model):
+  """Progress of incremental exports.
+
+  Surveys received up to and including watermark have been exported. The
+  manifest lists one dict per delta file written, oldest first. pending_job
+  is the ExportJob writing the next delta file, if one is running.
+  """
+  watermark = ndb.DateTimeProperty()
+  manifest = ndb.JsonProperty(default=[])
+  pending_job = ndb.KeyProperty(kind=ExportJob)
+
+
+class SurveyCounter(ndb.Model):
+  """Flushed total of a survey counter; the entity ID is the counter name."""
+  count = ndb.IntegerProperty(default=0, indexed=False)
@@ -0,0 +1,195 @@
+"""Restore exported survey data from Cloud Storage into the Datastore.
+
+This implements an admin-only page that reloads a file written by the export
+page (a JSON array or newline-delimited JSON, optionally gzip-compressed) into
+SurveyModel entities, for example to seed a staging datastore with production
+data.
+
+The file is read one line at a time, which works for both export formats
+because the exporter writes exactly one record per line. Each task restores
+a bounded number of records with large batched writes, then enqueues a task
+to continue from the byte offset where it stopped.
+
+Seeking in a gzip stream means decompressing it from the start, so
+compressed files are handed over at gzip member boundaries instead, where
+the next task can start decompressing from the compressed offset. Each part
+file of an export is its own member, so a task restores at least one whole
+part; a file compressed as a single member is restored by one task.
+"""
+
+import hashlib
+import json
+import logging
+import site
+import zlib
+
+site.addsitedir('lib')
+import cloudstorage as gcs
+
+from models import SurveyModel
+import webapp2
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+package = 'ChromeExperienceSampling'
+
+BUCKET_NAME = 'survey_responses'
+# Records restored by each task before it hands over to the next one.
+RECORDS_PER_TASK = 10000
+PUT_BATCH_SIZE = 500
+GZIP_READ_SIZE = 1 << 20
+
+RESTORE_PAGE_HTML = """\
+<html>
+  <body>
+    <form action='/restore' method='post'>
+      <div>File in %s: <input type='text' name='filename'></div>
+      <div><input type='submit' value='Start Restore'></div>
+    </form>
+  </body>
+</html>
+""" % BUCKET_NAME
+
+
+def _iter_lines(f):
+  """Yields the lines of an uncompressed file from its current position.
+
+  Yields (line, None) for each line, followed by (None, offset) with the
+  offset in f to resume from after that line.
+  """
+  while True:
+    line = f.readline()
+    if not line:
+      return
+    yield line, None
+    yield None, f.tell()
+
+
+def _iter_gzip_lines(f):
+  """Yields the decompressed lines of a gzip file from its current position.
+
+  The position must be the start of a gzip member. Yields (line, None) for
+  each line, and (None, offset) at the end of each member, with the offset
+  in f where the next member starts.
+  """
+  offset = f.tell()
+  decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  pending = ''
+  while True:
+    chunk = f.read(GZIP_READ_SIZE)
+    if not chunk:
+      break
+    offset += len(chunk)
+    while chunk:
+      lines = (pending + decompressor.decompress(chunk)).split('\n')
+      pending = lines.pop()
+      for line in lines:
+        yield line + '\n', None
+      # Input past the end of a member is left in unused_data.
+      chunk = decompressor.unused_data
+      if chunk:
+        if pending:
+          yield pending, None
+          pending = ''
+        yield None, offset - len(chunk)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  if pending:
+    yield pending, None
+  yield None, offset
+
+
+def _parse_line(line):
+  """Parses one line of an export file.
+
+  Returns:
+    The record on the line as a dict, or None if the line holds no record.
+  """
+  line = line.strip()
+  if line.startswith('['):
+    line = line[1:]
+  if line.endswith(']'):
+    line = line[:-1]
+  line = line.rstrip().rstrip(',')
+  if not line:
+    return None
+  return json.loads(line)
+
+
+class RestorePage(webapp2.RequestHandler):
+  """Serves a form to add a taskqueue job to restore data."""
+
+  def get(self):
+    self.response.write(RESTORE_PAGE_HTML)
+
+  def post(self):
+    taskqueue.add(url='/restore/worker',
+                  params={'filename': self.request.get('filename')})
+    self.redirect('/restore')
+
+
+class RestoreWorker(webapp2.RequestHandler):
+  """Taskqueue worker that restores part of an export file.
+
+  Takes the filename, the offset in the file to resume from, the matching
+  offset in the decompressed data and the number of records restored so far
+  from the previous task in the chain. Each restored survey's key is derived
+  from the file name and the record's offset in the decompressed data, so
+  retried tasks, or restoring the same file twice, overwrite instead of
+  duplicating.
+  """
+
+  def post(self):
+    filename = self.request.get('filename')
+    offset = int(self.request.get('offset') or 0)
+    position = int(self.request.get('position') or offset)
+    restored = int(self.request.get('restored') or 0)
+    key_prefix = 'restore-%s' % hashlib.sha1(filename).hexdigest()[:12]
+
+    futures = []
+    batch = []
+    done = True
+    records = 0
+    with gcs.open('/' + BUCKET_NAME + '/' + filename, 'r') as f:
+      f.seek(offset)
+      if filename.endswith('.gz'):
+        lines = _iter_gzip_lines(f)
+      else:
+        lines = _iter_lines(f)
+      for line, next_offset in lines:
+        if line is None:
+          # Only hand over where the next task can resume cheaply.
+          offset = next_offset
+          if records >= RECORDS_PER_TASK:
+            done = False
+            break
+          continue
+        line_position = position
+        position += len(line)
+        data = _parse_line(line)
+        if data is None:
+          continue
+        batch.append(SurveyModel.fromDict(
+            data, id='%s-%d' % (key_prefix, line_position)))
+        records += 1
+        if len(batch) == PUT_BATCH_SIZE:
+          # Keep parsing while the batch is being written.
+          futures.extend(ndb.put_multi_async(batch))
+          batch = []
+    futures.extend(ndb.put_multi_async(batch))
+    for future in futures:
+      future.get_result()
+    restored += records
+
+    if done:
+      logging.info('Restored %d surveys from %s' % (restored, filename))
+    else:
+      taskqueue.add(url='/restore/worker',
+                    params={'filename': filename, 'offset': offset,
+                            'position': position, 'restored': restored})
+
+APPLICATION = webapp2.WSGIApplication([
+    ('/restore/', RestorePage),
+    ('/restore', RestorePage),
+    ('/restore/worker', RestoreWorker)
+])
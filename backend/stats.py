@@ -0,0 +1,125 @@
+"""Timing instrumentation for the submit and export hot paths.
+
+Code being measured wraps each stage in a timer of a per-request Recorder:
+
+    recorder = stats.Recorder()
+    with recorder.timer('submit.put'):
+      survey.put()
+    recorder.flush()
+
+Timings are summed in the Recorder and added to memcache counters with one
+offset_multi call on flush, so instrumentation costs one memcache RPC per
+request. The admin-only /stats page shows the totals for each stage.
+Counters live in memcache only and restart from zero if it is evicted.
+"""
+
+import cgi
+import contextlib
+import time
+
+import webapp2
+
+from google.appengine.api import memcache
+
+package = 'ChromeExperienceSampling'
+
+MEMCACHE_NAMESPACE = 'stats'
+
+# Stages shown on the stats page, in order.
+STAGES = [
+    'submit.from_message',
+    'submit.put',
+    'submit.put_async',
+    'submit.enqueue',
+    'ingest.decode',
+    'ingest.put_multi',
+    'export.fetch_page',
+    'export.encode',
+    'export.gcs_write',
+]
+FIELDS = ['count', 'usec', 'bytes']
+
+STATS_PAGE_HTML = """\
+<html>
+  <body>
+    <table>
+      <tr><th>Stage</th><th>Count</th><th>Total s</th><th>Mean ms</th>
+          <th>Bytes</th><th>MB/s</th></tr>
+%s
+    </table>
+    <form action='/stats' method='post'>
+      <div><input type='submit' value='Reset'></div>
+    </form>
+  </body>
+</html>
+"""
+
+STATS_ROW_HTML = """\
+      <tr><td>%s</td><td>%d</td><td>%.3f</td><td>%.3f</td><td>%d</td>
+          <td>%.2f</td></tr>"""
+
+
+def _key(stage, field):
+  return '%s:%s' % (stage, field)
+
+
+class Recorder(object):
+  """Accumulates stage timings for one request."""
+
+  def __init__(self):
+    self._offsets = {}
+
+  def _add(self, stage, field, value):
+    key = _key(stage, field)
+    self._offsets[key] = self._offsets.get(key, 0) + value
+
+  def add(self, stage, seconds, size=0):
+    """Records one call of stage that took seconds and handled size bytes."""
+    self._add(stage, 'count', 1)
+    self._add(stage, 'usec', int(seconds * 1000000))
+    if size:
+      self._add(stage, 'bytes', size)
+
+  @contextlib.contextmanager
+  def timer(self, stage):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.add(stage, time.time() - start)
+
+  def flush(self):
+    """Adds the accumulated timings to the memcache counters."""
+    if self._offsets:
+      memcache.offset_multi(self._offsets, namespace=MEMCACHE_NAMESPACE,
+                            initial_value=0)
+      self._offsets = {}
+
+
+class StatsPage(webapp2.RequestHandler):
+  """Shows the accumulated timings of every stage, and resets them."""
+
+  def get(self):
+    keys = [_key(stage, field) for stage in STAGES for field in FIELDS]
+    values = memcache.get_multi(keys, namespace=MEMCACHE_NAMESPACE)
+    rows = []
+    for stage in STAGES:
+      count, usec, size = [int(values.get(_key(stage, field), 0))
+                           for field in FIELDS]
+      seconds = usec / 1000000.0
+      rows.append(STATS_ROW_HTML % (
+          cgi.escape(stage), count, seconds,
+          seconds * 1000 / count if count else 0, size,
+          size / 1048576.0 / seconds if seconds else 0))
+    self.response.write(STATS_PAGE_HTML % '\n'.join(rows))
+
+  def post(self):
+    memcache.delete_multi(
+        [_key(stage, field) for stage in STAGES for field in FIELDS],
+        namespace=MEMCACHE_NAMESPACE)
+    self.redirect('/stats')
+
+APPLICATION = webapp2.WSGIApplication([
+    ('/stats/', StatsPage),
+    ('/stats', StatsPage)
+])
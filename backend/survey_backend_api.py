@@ -3,15 +3,77 @@
 Implemented using Google Cloud Endpoints for App Engine.
 """
 
+import hashlib
+import logging
+import time
+
 import endpoints
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+import counters
+import ingest
+from messages import SubmitResultMessage
+from messages import SurveyBatchMessage
+from messages import SurveyBatchResultMessage
+from messages import SurveyListMessage
 from messages import SurveyMessage
+from messages import SurveyQueryMessage
 import models
+import stats
+
+from google.appengine.api import memcache
+from google.appengine.api import oauth
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
 package = 'ChromeExperienceSampling'
 
+# How survey_submit stores incoming surveys:
+#   'sync': write to the Datastore before responding.
+#   'async': start the write asynchronously; failed writes are retried from a
+#       push task instead of failing the request with a 500. The response is
+#       still only sent once the write finishes (see APPLICATION), so this
+#       doesn't lower latency; use 'queue' for that.
+#   'queue': only buffer the survey in the ingest pull queue; a cron worker
+#       commits buffered surveys to the Datastore in bulk.
+SUBMIT_MODE = 'sync'
+RETRY_QUEUE_NAME = 'survey-retry'
+RETRY_WORKER_URL = '/tasks/retrysurvey'
+MAX_LIST_PAGE_SIZE = 100
+LIST_CACHE_NAMESPACE = 'survey_pages'
+# New surveys can change the first page of results, so don't cache for long.
+LIST_CACHE_SECONDS = 60
+INVALID_SUBMISSION_ID = 'Invalid submission_id.'
+
+
+def _require_admin():
+  if endpoints.get_current_user() is None:
+    raise endpoints.UnauthorizedException('Sign-in required.')
+  if not oauth.is_current_user_admin(endpoints.EMAIL_SCOPE):
+    raise endpoints.ForbiddenException('Admin access required.')
+
+
+@ndb.tasklet
+def _store_survey_async(message, recorder):
+  """Writes a survey, handing it to the retry queue if the write fails."""
+  with recorder.timer('submit.from_message'):
+    survey = models.SurveyModel.fromMessage(message)
+  start = time.time()
+  try:
+    yield survey.put_async()
+    recorder.add('submit.put_async', time.time() - start)
+    ingest.remember_submissions([message.submission_id])
+  except Exception as e:
+    logging.warning('Survey write failed, queueing retry: %s' % e)
+    taskqueue.add(queue_name=RETRY_QUEUE_NAME, url=RETRY_WORKER_URL,
+                  payload=protojson.encode_message(message))
+  else:
+    counters.count_surveys([message.survey_type])
+  recorder.flush()
+
 
 @endpoints.api(name='cesp', version='v1',
                scopes=[endpoints.EMAIL_SCOPE])
@@ -22,8 +84,122 @@ class ExperienceSamplingApi(remote.Service):
                     path='submitsurvey', http_method='POST',
                     name='submitSurvey')
   def survey_submit(self, request):
-    survey = models.SurveyModel.fromMessage(request)
-    survey.put()
+    if not ingest.is_valid_submission_id(request.submission_id):
+      raise endpoints.BadRequestException(INVALID_SUBMISSION_ID)
+    recorder = stats.Recorder()
+    if SUBMIT_MODE == 'queue':
+      # Duplicates are dropped in bulk by the ingest worker.
+      with recorder.timer('submit.enqueue'):
+        ingest.enqueue_survey(request)
+      recorder.flush()
+    elif not ingest.check_new_submissions([request])[0]:
+      return message_types.VoidMessage()
+    elif SUBMIT_MODE == 'async':
+      # The tasklet flushes the recorder once the write completes.
+      _store_survey_async(request, recorder)
+    else:
+      with recorder.timer('submit.from_message'):
+        survey = models.SurveyModel.fromMessage(request)
+      with recorder.timer('submit.put'):
+        survey.put()
+      recorder.flush()
+      ingest.remember_submissions([request.submission_id])
+      counters.count_surveys([request.survey_type])
     return message_types.VoidMessage()
 
-APPLICATION = endpoints.api_server([ExperienceSamplingApi])
+  @endpoints.method(SurveyBatchMessage, SurveyBatchResultMessage,
+                    path='submitsurveybatch', http_method='POST',
+                    name='submitSurveyBatch')
+  def survey_batch_submit(self, request):
+    """Stores a batch of surveys using one batched Datastore write.
+
+    Returns one result per submitted survey, in the same order, so the client
+    knows which surveys it still needs to resend. A survey with an invalid
+    submission_id fails on its own, without failing the rest of the batch.
+    """
+    valid = [ingest.is_valid_submission_id(m.submission_id)
+             for m in request.surveys]
+    is_new = iter(ingest.check_new_submissions(
+        [m for m, ok in zip(request.surveys, valid) if ok]))
+    is_new = [ok and next(is_new) for ok in valid]
+    new_messages = [m for m, new in zip(request.surveys, is_new) if new]
+    # put_multi_async issues a single batched RPC but gives us a future per
+    # entity, so one failed write doesn't hide the outcome of the others.
+    futures = iter(ndb.put_multi_async(
+        map(models.SurveyModel.fromMessage, new_messages)))
+    results = []
+    stored = []
+    for message, ok, new in zip(request.surveys, valid, is_new):
+      if not ok:
+        results.append(SubmitResultMessage(success=False,
+                                           error=INVALID_SUBMISSION_ID))
+        continue
+      if not new:
+        # Already stored by an earlier submission.
+        results.append(SubmitResultMessage(success=True))
+        continue
+      try:
+        next(futures).get_result()
+        results.append(SubmitResultMessage(success=True))
+        stored.append(message)
+      except Exception as e:
+        logging.warning('Batch survey write failed: %s' % e)
+        results.append(SubmitResultMessage(success=False, error=str(e)))
+    ingest.remember_submissions([m.submission_id for m in stored])
+    counters.count_surveys([m.survey_type for m in stored])
+    return SurveyBatchResultMessage(results=results)
+
+  @endpoints.method(SurveyQueryMessage, SurveyListMessage,
+                    path='surveys', http_method='GET',
+                    name='listSurveys')
+  def survey_list(self, request):
+    """Returns one page of surveys for a participant and/or survey type.
+
+    Only filters on indexed equality properties, so no composite index is
+    needed. Pages are cached in memcache, keyed by the query and cursor.
+    Admin only.
+    """
+    _require_admin()
+    page_size = max(1, min(request.page_size, MAX_LIST_PAGE_SIZE))
+    cache_key = hashlib.sha1(repr((request.participant_id,
+                                   request.survey_type, page_size,
+                                   request.cursor))).hexdigest()
+    cached = memcache.get(cache_key, namespace=LIST_CACHE_NAMESPACE)
+    if cached is not None:
+      return protojson.decode_message(SurveyListMessage, cached)
+
+    query = models.SurveyModel.query()
+    if request.participant_id:
+      query = query.filter(
+          models.SurveyModel.participant_id == request.participant_id)
+    if request.survey_type:
+      query = query.filter(
+          models.SurveyModel.survey_type == request.survey_type)
+    try:
+      cursor = Cursor(urlsafe=request.cursor) if request.cursor else None
+    except Exception:
+      raise endpoints.BadRequestException('Invalid cursor.')
+    surveys, next_cursor, more = query.fetch_page(page_size,
+                                                  start_cursor=cursor)
+
+    result = SurveyListMessage(
+        surveys=[survey.toMessage() for survey in surveys],
+        next_cursor=next_cursor.urlsafe() if next_cursor and more else None,
+        more=more)
+    memcache.set(cache_key, protojson.encode_message(result),
+                 time=LIST_CACHE_SECONDS, namespace=LIST_CACHE_NAMESPACE)
+    return result
+
+_API_SERVER = endpoints.api_server([ExperienceSamplingApi])
+
+
+@ndb.toplevel
+def APPLICATION(environ, start_response):
+  """Serves the API, then waits for any writes still in flight.
+
+  toplevel waits for async submit writes (and any retry tasks they enqueue)
+  before the response is returned, so async mode only saves the time to
+  encode the response; its benefit is that a failed write is retried instead
+  of returning a 500. Queue mode takes the write off the response path.
+  """
+  return _API_SERVER(environ, start_response)
@@ -47,6 +47,23 @@ SurveySubmission.SurveyRecord = function(type, participantId, dateTaken,
   this.participantId = participantId;
   this.dateTaken = dateTaken;
   this.responses = responses;
+  this.submissionId = SurveySubmission.generateSubmissionId();
+}
+
+/**
+ * Generates a random ID for a survey submission. The ID is saved with the
+ * survey and sent with every attempt to submit it, so the backend can
+ * recognize retries of a submission it already stored.
+ * @returns {string} 32 random hex digits.
+ */
+SurveySubmission.generateSubmissionId = function() {
+  var bytes = new Uint8Array(16);
+  crypto.getRandomValues(bytes);
+  var id = '';
+  for (var i = 0; i < bytes.length; i++) {
+    id += (bytes[i] < 16 ? '0' : '') + bytes[i].toString(16);
+  }
+  return id;
 }
 
 /**
@@ -238,6 +255,10 @@ SurveySubmission.sendSurveyRecord = function(surveyRecord, successCallback,
     'responses': [],
     'survey_type': surveyRecord.type
   };
+  // Surveys queued before submission IDs were introduced don't have one.
+  if (surveyRecord.submissionId) {
+    data.submission_id = surveyRecord.submissionId;
+  }
   for (var i = 0; i < surveyRecord.responses.length; i++) {
     data.responses.push(surveyRecord.responses[i]);
   }
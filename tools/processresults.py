@@ -4,12 +4,21 @@ Has one public function, ProcessResults, used like this from interpreter:
     ProcessResults('2015-01-06cuesDogfoodData.json', '2015-01-06-')
 """
 
+import array
 import csv
 import dateutil.parser
+import dateutil.tz
 from datetime import datetime
+import gzip
+import itertools
 import json
 import logging
+import multiprocessing
+import os
 import re
+import shutil
+import sqlite3
+import sys
 
 DOGFOOD_START_DATE = datetime(2014, 12, 01, 0, 0, 0, 0)
 DEMOGRAPHIC_STABLE_DATE = datetime(2014, 12, 18, 0, 0, 0, 0)
@@ -21,6 +30,7 @@ PUBLIC_LAUNCH_DATE = datetime(2015, 5, 11, 13, 30, 0, 0)
 
 DEMOGRAPHIC_CSV_PREFIX = 'demographics'
 MANUFACTURED_CSV_PREFIX = 'manufactured'
+QUARANTINE_SUFFIX = '-quarantine.json'
 CONDITIONS = [
     'ssl-overridable-proceed', 'ssl-overridable-noproceed',
     'ssl-nonoverridable', 'malware-proceed', 'malware-noproceed',
@@ -29,13 +39,57 @@ CONDITIONS = [
 TECHFAMILIAR_QUESTION_PREFIX = ('How familiar are you with each of the '
     'following computer and Internet-related items? I have...')
 ATTRIBUTE_QUESTION_PREFIX = 'To what degree do each of the following'
+JSON_READ_CHUNK_SIZE = 1 << 20
+CSV_WRITE_BUFFER_SIZE = 1 << 20
+SQLITE_BATCH_SIZE = 1000
+# Workers load their tables into the same SQLite file, so they may have to
+# wait for each other's transactions.
+SQLITE_TIMEOUT_SECONDS = 600
+SQLITE_INDEXED_FIELDS = ['participant_id', 'survey_type', 'date_taken']
+COLUMNAR_SUFFIX = '.columns'
+COLUMNAR_MANIFEST = 'manifest.json'
+# array typecodes for column codes, narrowest first, with the little-endian
+# NumPy dtype each file can be memory-mapped as.
+COLUMNAR_CODE_TYPES = [('B', '<u1'), ('H', '<u2'), ('I', '<u4')]
+# Columns that are stored plainly, since nearly every row has its own value.
+COLUMNAR_PLAIN_FIELDS = ['date_received', 'date_taken', 'participant_id']
+# Other columns are dictionary-encoded if they have at most
+# COLUMNAR_SMALL_DICTIONARY distinct values, or at most one distinct value
+# per two rows, up to COLUMNAR_MAX_DICTIONARY_VALUES.
+COLUMNAR_SMALL_DICTIONARY = 32
+COLUMNAR_MAX_DICTIONARY_VALUES = 1 << 16
+METADATA_FIELDS = ['date_received', 'date_taken', 'participant_id',
+                   'survey_type']
+# Timestamps as written by the exporter: naive ISO-8601, with microseconds
+# omitted when they are zero.
+ISO_TIMESTAMP_RE = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d{6})?$')
+CHOSEN_RE = re.compile(r'"Proceed to.*?"')
+ALTERNATIVE_RE = re.compile(r'"Back to safety\."')
+
+# Question texts repeat almost exactly across results, so work that depends
+# only on the questions is done once per distinct text or question list:
+# question text -> question ID, and question ID -> question text
+_question_ids = {}
+_question_texts = []
+# (question prefix, schema) -> (attribute question indices, sorted order)
+_attribute_layouts = {}
+# first question ID -> ID of the question with the URL replaced by placeholders
+_placeholder_questions = {}
+# Job name -> (write function, args) of the jobs _RunWriteJobs is running in
+# a process pool, inherited by the pool's workers when they are forked.
+_write_jobs = {}
 
 
 def ProcessResults(
     json_in_file,
     csv_prefix,
     filter_items_before_date = PUBLIC_LAUNCH_DATE,
-    filter_demographic_items_before_date = PUBLIC_LAUNCH_DATE):
+    filter_demographic_items_before_date = PUBLIC_LAUNCH_DATE,
+    workers = 1,
+    state_file = None,
+    sqlite_file = None,
+    columnar = False,
+    full_export_file = None):
   """Take results from AppEngine JSON file, process, and write to CSV file.
 
   Results from the input JSON file will be filtered into the 9 experimental
@@ -47,47 +101,538 @@ def ProcessResults(
   will be ignored and not copied to the CSV file.
 
   Args:
-    json_in_file: File with raw AppEngine results in JSON format
+    json_in_file: File with raw AppEngine results in JSON format, either as
+        one JSON array or as newline-delimited JSON, optionally gzipped
+        (file name ending in .gz). The file is parsed one record at a time.
+        May also be a list of such files, e.g. the delta files listed in
+        the incremental export manifest, which are read in order.
     csv_prefix: Prefix to output CSV files. These files will be named
         in the format <csv_prefix><condition>.csv. For example, if
         csv_prefix is '2015-01-15-' then one output file would be
         named 2015-01-15-ssl-overridable-proceed.csv
+    workers: Number of processes to write the output files with. Each
+        condition, plus the demographic and manufactured outputs, is
+        processed and written independently, so with more than one worker
+        they are spread over a process pool. The pool is forked after the
+        results are partitioned, so the workers inherit them instead of
+        having them pickled and sent over.
+    state_file: Optional JSON file for incremental runs. It records the
+        latest date_received processed and the CSV header of each output.
+        When it exists, only results received after that date are
+        processed, and they are appended to the existing output files, so
+        json_in_file only needs to hold the new results. An output whose
+        header would change, for example because a new question appeared,
+        is rebuilt from full_export_file; the other outputs are left as they
+        are. Without a full_export_file such an output is skipped with an
+        error, and the run's results are read again by the next run, since
+        rebuilding it from json_in_file alone would drop its earlier rows.
+        The state file is created or updated at the end of the run.
+        It also checkpoints each output. If writing an output raises, the
+        rows it had appended are removed again and the exception is raised
+        at the end of the run, but the outputs that were written keep their
+        new rows and checkpoints, so rerunning the same input only adds the
+        new results to the outputs that failed.
+    sqlite_file: Optional SQLite database to also load the outputs into. Each
+        output gets a table named like its CSV file without the prefix, e.g.
+        "ssl-overridable-proceed", with the same columns as the CSV file,
+        indexed on participant_id, survey_type and date_taken.
+    columnar: If true, each output is also written in a columnar form, to a
+        directory named like its CSV file with COLUMNAR_SUFFIX instead of
+        .csv. See _WriteColumnar.
+    full_export_file: File or list of files with all results, read only if
+        an incremental run has to rebuild an output.
 
   Returns:
     None
   """
-  demo_results, parsed_events = _ParseSurveyResults(json_in_file)
+  state = _LoadState(state_file)
+  last_date_received = state['last_date_received']
+  headers = state['headers']
+  checkpoints = state.setdefault('checkpoints', {})
+  new_results = _IterInputResults(json_in_file)
+  if state_file:
+    # Drop results that were already processed before parsing them any
+    # further, so a run costs time in proportion to the new results.
+    new_results = _TrackDateReceived(new_results, last_date_received, state)
+  new_results = itertools.imap(SurveyResult.FromDict, new_results)
+  outputs = _PartitionOutputs(
+      new_results, filter_items_before_date,
+      filter_demographic_items_before_date)
+
+  jobs = []
+  rebuild = set()
+  for name, function, results in outputs:
+    out_file = csv_prefix + name + '.csv'
+    if last_date_received is None:
+      jobs.append((name, function,
+                   (results, out_file, None, sqlite_file, name, columnar)))
+      continue
+    checkpoint = checkpoints.get(name)
+    if checkpoint and checkpoint['last_date_received'] > last_date_received:
+      # A run that failed on another output already wrote these results.
+      results = [r for r in results
+                 if _NormalizeTimestamp(r.date_received) >
+                 checkpoint['last_date_received']]
+    if not results:
+      # Nothing new for this output, so leave its file and header alone.
+      continue
+    elif headers.get(name) and os.path.exists(out_file):
+      if checkpoint:
+        # Drop anything a run that was interrupted left after the checkpoint.
+        _RollBackOutput(out_file, checkpoint, sqlite_file, name, columnar)
+      jobs.append((name, function,
+                   (results, out_file, headers[name], sqlite_file, name,
+                    columnar)))
+    else:
+      rebuild.add(name)
+  written = _RunWriteJobs(jobs, workers)
+
+  # Outputs that couldn't be appended to are rewritten from all results.
+  rebuild.update(name for name, _, args in jobs
+                 if args[2] and written[name][0] and written[name][0][0] and
+                 written[name][0][0] != args[2])
+  appended = set(name for name, _, args in jobs
+                 if args[2] and name not in rebuild)
+  complete = True
+  if rebuild and not full_export_file:
+    for name in sorted(rebuild):
+      logging.error('Not rebuilding %s without a full_export_file' % name)
+      written.pop(name, None)
+    complete = False
+  elif rebuild:
+    logging.info('Rebuilding %s' % ', '.join(sorted(rebuild)))
+    jobs = [(name, function,
+             (results, csv_prefix + name + '.csv', None, sqlite_file, name,
+              columnar))
+            for name, function, results in _PartitionOutputs(
+                itertools.imap(SurveyResult.FromDict,
+                               _IterInputResults(full_export_file)),
+                filter_items_before_date, filter_demographic_items_before_date)
+            if name in rebuild]
+    written.update(_RunWriteJobs(jobs, workers))
+
+  # Each output that was written is checkpointed, so if another output
+  # failed, rerunning the same input doesn't write its results twice. The
+  # run as a whole only counts as done if every output was written.
+  first_exception = None
+  for name, _, _ in outputs:
+    if name not in written:
+      continue
+    out_file = csv_prefix + name + '.csv'
+    result, exception = written[name]
+    if exception is not None:
+      first_exception = first_exception or exception
+      if name in appended and checkpoints.get(name):
+        _RollBackOutput(out_file, checkpoints[name], sqlite_file, name,
+                        columnar)
+      else:
+        # A partly rewritten output has to be rewritten again.
+        headers.pop(name, None)
+        checkpoints.pop(name, None)
+      continue
+    header, error = result
+    if error:
+      logging.warning('Exception in %s: %s' % (name, error))
+    elif header:
+      headers[name] = header
+    checkpoints[name] = _OutputCheckpoint(out_file, sqlite_file, name,
+                                          columnar)
+    checkpoints[name]['last_date_received'] = state['last_date_received']
+  if first_exception is not None or not complete:
+    state['last_date_received'] = last_date_received
+  if state_file:
+    _SaveState(state_file, state)
+  if first_exception is not None:
+    raise first_exception
+
+
+def _OutputCheckpoint(out_file, sqlite_file, table, columnar):
+  """Record how much of each file an output consists of
+
+  Args:
+    out_file: The output's CSV file.
+    sqlite_file: SQLite database the output is loaded into, or None.
+    table: Name of the output's SQLite table.
+    columnar: Whether the output is also written in columnar form.
+
+  Returns:
+    Dict with the sizes of the CSV and quarantine files in bytes, and the
+    number of rows in the SQLite table and the columnar directory, if they
+    are written.
+  """
+  checkpoint = {}
+  for key, path in (('csv_size', out_file),
+                    ('quarantine_size',
+                     os.path.splitext(out_file)[0] + QUARANTINE_SUFFIX)):
+    checkpoint[key] = os.path.getsize(path) if os.path.exists(path) else 0
+  if sqlite_file:
+    connection = sqlite3.connect(sqlite_file, timeout=SQLITE_TIMEOUT_SECONDS)
+    try:
+      checkpoint['sqlite_rowid'] = connection.execute(
+          'SELECT MAX(rowid) FROM %s' % _QuoteSqlite(table)).fetchone()[0] or 0
+    except sqlite3.OperationalError:
+      # The output had nothing to write, so its table doesn't exist.
+      checkpoint['sqlite_rowid'] = 0
+    finally:
+      connection.close()
+  if columnar:
+    manifest_file = os.path.join(
+        os.path.splitext(out_file)[0] + COLUMNAR_SUFFIX, COLUMNAR_MANIFEST)
+    checkpoint['columnar_rows'] = 0
+    if os.path.exists(manifest_file):
+      with open(manifest_file, 'r') as f:
+        checkpoint['columnar_rows'] = json.load(f)['rows']
+  return checkpoint
+
+
+def _RollBackOutput(out_file, checkpoint, sqlite_file, table, columnar):
+  """Cut an output back to what it held at checkpoint
+
+  Rows are only ever appended to an output, so this removes the rows that
+  were added after the checkpoint was taken, by a run that then failed.
+
+  Args:
+    out_file: The output's CSV file.
+    checkpoint: Dict returned by _OutputCheckpoint.
+    sqlite_file: SQLite database the output is loaded into, or None.
+    table: Name of the output's SQLite table.
+    columnar: Whether the output is also written in columnar form.
+
+  Returns:
+    None.
+  """
+  _TruncateFile(out_file, checkpoint['csv_size'])
+  quarantine_file_name = os.path.splitext(out_file)[0] + QUARANTINE_SUFFIX
+  if checkpoint['quarantine_size']:
+    _TruncateFile(quarantine_file_name, checkpoint['quarantine_size'])
+  elif os.path.exists(quarantine_file_name):
+    os.remove(quarantine_file_name)
+  if sqlite_file and 'sqlite_rowid' in checkpoint:
+    connection = sqlite3.connect(sqlite_file, timeout=SQLITE_TIMEOUT_SECONDS)
+    try:
+      with connection:
+        connection.execute('DELETE FROM %s WHERE rowid > ?' %
+                           _QuoteSqlite(table), (checkpoint['sqlite_rowid'],))
+    except sqlite3.OperationalError:
+      pass
+    finally:
+      connection.close()
+  if columnar and 'columnar_rows' in checkpoint:
+    _TruncateColumnar(os.path.splitext(out_file)[0] + COLUMNAR_SUFFIX,
+                      checkpoint['columnar_rows'])
+
+
+def _PartitionOutputs(results, discard_before_date,
+                      discard_demographic_before_date):
+  """Partition results into the list of outputs ProcessResults writes.
+
+  Returns:
+    List of (name, write function, results) tuples, where name is the output
+    file name without the CSV prefix and extension.
+  """
+  demo_results, manuf_events, condition_results = _PartitionResults(
+      results, discard_before_date, discard_demographic_before_date)
+  outputs = [
+      (DEMOGRAPHIC_CSV_PREFIX, _WriteDemographicCsv, demo_results),
+      (MANUFACTURED_CSV_PREFIX, _WriteManufacturedCsv, manuf_events)]
+  outputs.extend((c, _WriteConditionCsv, condition_results[c])
+                 for c in CONDITIONS)
+  return outputs
 
-  demo_results, demo_index = _FilterDemographicResults(
-      demo_results, filter_demographic_items_before_date)
-  _WriteToCsv(demo_results, demo_index, csv_prefix +
-              DEMOGRAPHIC_CSV_PREFIX + '.csv')
 
-  parsed_events = _DiscardResultsBeforeDate(parsed_events,
-                                            filter_items_before_date)
+def _RunWriteJobs(jobs, workers):
+  """Run write jobs, in a process pool if workers is more than one.
 
-  manuf_events, manuf_index = _FilterManufacturedEvents(parsed_events)
-  _WriteToCsv(manuf_events, manuf_index,
-              csv_prefix + MANUFACTURED_CSV_PREFIX + '.csv')
+  Args:
+    jobs: List of (name, write function, args) tuples.
+    workers: Number of processes to run the jobs with.
 
-  for c in CONDITIONS:
+  Returns:
+    Dict mapping each job name to a (result, exception) tuple, as returned
+    by _RunWriteJob. Every job is run, even if an earlier one raised.
+  """
+  if workers > 1:
+    # Pickling the results for the workers would cost more than writing
+    # them, so the jobs are left in _write_jobs for the forked workers to
+    # inherit, and each worker is only sent the name of its job.
+    _write_jobs.clear()
+    _write_jobs.update((name, (function, args))
+                       for name, function, args in jobs)
     try:
-      filtered_results = _FilterByCondition(c, parsed_events)
-      filtered_results, canonical_index = _CanonicalizeQuestions(
-          filtered_results)
-      _WriteToCsv(filtered_results, canonical_index, csv_prefix + c + '.csv')
-    except UnexpectedFormatException as e:
-      # Log UnexpectedFormatException and continue, since they are usually
-      # due to lack of data for a condition.
-      logging.warning('Exception in %s: %s' % (c, e.value))
+      pool = multiprocessing.Pool(workers)
+      try:
+        pending = [(name, pool.apply_async(_RunInheritedWriteJob, (name,)))
+                   for name, _, _ in jobs]
+        outcomes = [(name, p.get()) for name, p in pending]
+      finally:
+        pool.close()
+        pool.join()
+    finally:
+      _write_jobs.clear()
+  else:
+    outcomes = [(name, _RunWriteJob(function, args))
+                for name, function, args in jobs]
+
+  return dict(outcomes)
+
+
+def _RunInheritedWriteJob(name):
+  """Run the job named name from the _write_jobs inherited from the parent."""
+  return _RunWriteJob(*_write_jobs[name])
+
+
+def _RunWriteJob(function, args):
+  """Run one write job, returning any exception instead of raising it.
+
+  Our exceptions derive from BaseException, which a multiprocessing worker
+  doesn't catch; the worker would die and the job would never return. So
+  every exception is returned to the parent, which raises it.
+
+  Returns:
+    (result, None) if function returned result, or (None, exception).
+  """
+  try:
+    return function(*args), None
+  except BaseException as e:
+    return None, e
+
+
+def _WriteDemographicCsv(demo_results, out_file, append_header=None,
+                         sqlite_file=None, table=None, columnar=False):
+  """Clean demographic results and write them to out_file.
+
+  Results with badly formatted techFamiliar questions are written to a
+  quarantine file next to out_file, named with QUARANTINE_SUFFIX instead of
+  .csv, as newline-delimited JSON objects with the result and the reason it
+  was rejected. The file is only written if there are such results.
+
+  Returns:
+    (header, None), for consistency with _WriteConditionCsv.
+  """
+  quarantine = []
+  demo_results, demo_index = _CleanDemographicResults(demo_results, quarantine)
+  quarantine_file_name = os.path.splitext(out_file)[0] + QUARANTINE_SUFFIX
+  if quarantine:
+    with open(quarantine_file_name,
+              'a' if append_header else 'w') as quarantine_file:
+      for r, reason in quarantine:
+        quarantine_file.write(
+            json.dumps({'reason': reason, 'result': r.ToDict()}) + '\n')
+  elif not append_header and os.path.exists(quarantine_file_name):
+    # Don't leave the quarantine of an earlier run next to the new output.
+    os.remove(quarantine_file_name)
+  return _WriteOutputs(demo_results, demo_index, out_file, append_header,
+                       sqlite_file, table, columnar), None
+
+
+def _WriteManufacturedCsv(manuf_events, out_file, append_header=None,
+                          sqlite_file=None, table=None, columnar=False):
+  """Write manufactured events to out_file.
+
+  Returns:
+    (header, None), for consistency with _WriteConditionCsv.
+  """
+  return _WriteOutputs(manuf_events, _GetCanonicalIndex(manuf_events),
+                       out_file, append_header, sqlite_file, table,
+                       columnar), None
+
+
+def _WriteConditionCsv(results, out_file, append_header=None,
+                       sqlite_file=None, table=None, columnar=False):
+  """Canonicalize the results for one condition and write them to out_file.
+
+  Returns:
+    (header, error), where header is the header returned by _WriteToCsv and
+    error is None on success. If an UnexpectedFormatException stopped the
+    condition from being written, header is None and error is its message.
+    Those are usually due to lack of data for a condition, so the caller
+    only logs them.
+  """
+  try:
+    results, canonical_index = _CanonicalizeQuestions(results)
+    return _WriteOutputs(results, canonical_index, out_file, append_header,
+                         sqlite_file, table, columnar), None
+  except UnexpectedFormatException as e:
+    return None, e.value
+
+
+def _WriteOutputs(results, canonical_index, out_file, append_header,
+                  sqlite_file, table, columnar):
+  """Write results to out_file, and to the other outputs that are enabled.
+
+  Args and return value are as for _WriteToCsv. The SQLite table and the
+  columnar directory are only written if the CSV file was.
+  """
+  header = _WriteToCsv(results, canonical_index, out_file, append_header)
+  if append_header is not None and header != append_header:
+    return header
+  if sqlite_file:
+    _WriteToSqlite(results, header, sqlite_file, table,
+                   append_header is not None)
+  if columnar:
+    _WriteColumnar(results, header,
+                   os.path.splitext(out_file)[0] + COLUMNAR_SUFFIX,
+                   append_header is not None)
+  return header
+
+
+def _LoadState(state_file):
+  """Load the state of the last incremental run.
+
+  Args:
+    state_file: JSON file written by _SaveState, or None.
+
+  Returns:
+    Dict with the normalized 'last_date_received' (None if there was no
+    previous run), the 'headers' dict mapping output names to the list of
+    CSV columns in their files, and the 'checkpoints' dict mapping output
+    names to their last checkpoint, as returned by _OutputCheckpoint plus the
+    'last_date_received' of the results written up to it.
+  """
+  if state_file and os.path.exists(state_file):
+    with open(state_file, 'r') as f:
+      return json.load(f)
+  return {'last_date_received': None, 'headers': {}}
+
+
+def _SaveState(state_file, state):
+  """Write state to state_file, replacing it only once fully written."""
+  with open(state_file + '.tmp', 'w') as f:
+    json.dump(state, f, indent=2, sort_keys=True)
+  os.rename(state_file + '.tmp', state_file)
+
+
+def _TrackDateReceived(results, last_date_received, state):
+  """Yield results received after last_date_received.
+
+  Also records the latest date_received seen in state['last_date_received'],
+  so the next incremental run can start after it.
+
+  Args:
+    results: Iterable of results parsed from a raw JSON file into dicts
+    last_date_received: Normalized timestamp, as returned by
+      _NormalizeTimestamp, or None to yield every result.
+    state: State dict to update.
+
+  Yields:
+    Each result dict received after last_date_received.
+  """
+  for r in results:
+    date_received = _NormalizeTimestamp(r['date_received'])
+    if last_date_received is not None and date_received <= last_date_received:
+      continue
+    if (state['last_date_received'] is None or
+        date_received > state['last_date_received']):
+      state['last_date_received'] = date_received
+    yield r
+
+
+def _IterInputResults(in_files):
+  """Yield results from one AppEngine JSON file, or from a list of them.
 
+  Args:
+    in_files: File name, or list of file names read in order.
+
+  Yields:
+    Each result in the files, as a dict.
+  """
+  if isinstance(in_files, basestring):
+    in_files = [in_files]
+  for in_file in in_files:
+    for result in _IterSurveyResults(in_file):
+      yield result
+
+
+def _IterSurveyResults(in_file):
+  """Yield results from an AppEngine JSON file one at a time.
+
+  Reads either a JSON array of results or newline-delimited JSON, without
+  loading the whole file, so memory use doesn't grow with the file size.
+  Files whose name ends in .gz are decompressed on the fly.
+
+  Args:
+    in_file: File with raw AppEngine results in JSON format
+
+  Yields:
+    Each result in the file, as a dict.
+
+  Raises:
+    ValueError: The file is not valid JSON.
+  """
+  decoder = json.JSONDecoder()
+  opener = gzip.open if in_file.endswith('.gz') else open
+  with opener(in_file, 'rb') as json_file:
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+      # Skip whitespace and the array brackets and commas between results.
+      while pos < len(buf) and buf[pos] in ' \t\r\n[],':
+        pos += 1
+      if pos == len(buf):
+        if eof:
+          return
+        buf = json_file.read(JSON_READ_CHUNK_SIZE)
+        pos = 0
+        eof = not buf
+        continue
+      try:
+        result, pos = decoder.raw_decode(buf, pos)
+      except ValueError:
+        # Most likely the result continues in the next chunk.
+        if eof:
+          raise
+        chunk = json_file.read(JSON_READ_CHUNK_SIZE)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+        continue
+      yield result
+
+
+def _PartitionResults(results, discard_before_date,
+                      discard_demographic_before_date):
+  """Route each result to the output it belongs to, in a single pass.
+
+  Demographic results go to one list, and event results are split into
+  manufactured events and one list per condition, keyed by survey_type.
+  Results taken before the relevant date are dropped as they are read, so
+  they are never held in memory.
+
+  Args:
+    results: Iterable of SurveyResults
+    discard_before_date: A date of type datetime.datetime; event results
+      taken before this date will be discarded
+    discard_demographic_before_date: A date of type datetime.datetime;
+      demographic results taken before this date will be discarded
 
-def _ParseSurveyResults(in_file):
-  with open(in_file, 'r') as json_file:
-    parsed = json.load(json_file)
-  demographic = filter(lambda x: x['survey_type'] == 'setup.js', parsed)
-  events = filter(lambda x: x['survey_type'] != 'setup.js', parsed)
-  return demographic, events
+  Returns:
+    (1) List of demographic results
+    (2) List of manufactured events
+    (3) Dict mapping each condition in CONDITIONS to a list of its results
+  """
+  condition_by_survey_type = dict((c + '.js', c) for c in CONDITIONS)
+  discard_before = _NormalizeTimestamp(discard_before_date.isoformat())
+  discard_demographic_before = _NormalizeTimestamp(
+      discard_demographic_before_date.isoformat())
+  demographic = []
+  manufactured = []
+  by_condition = dict((c, []) for c in CONDITIONS)
+  manufactured_id = _InternQuestion('MANUFACTURED')
+  for r in results:
+    survey_type = r.survey_type
+    if survey_type == 'setup.js':
+      if r.taken >= discard_demographic_before:
+        demographic.append(r)
+      continue
+    if r.taken < discard_before:
+      continue
+    if r.questions[0] == manufactured_id:
+      manufactured.append(r)
+    condition = condition_by_survey_type.get(survey_type)
+    if condition:
+      by_condition[condition].append(r)
+  return demographic, manufactured, by_condition
 
 
 def _FilterDemographicResults(demo_res, discard_before_date):
@@ -97,8 +642,7 @@ def _FilterDemographicResults(demo_res, discard_before_date):
     order.
 
   Args:
-    parsed_demo: Results from demographic survey parsed from a raw JSON
-      file into list of dicts
+    parsed_demo: SurveyResults from the demographic survey
     discard_before_date: A date of type datetime.datetime; demographic
       survey results before this date will be discarded
 
@@ -110,23 +654,44 @@ def _FilterDemographicResults(demo_res, discard_before_date):
     (2) Integer index into the results list indicating which list
     element's questions can be considered canonical and complete.
   """
-  filtered_results = _DiscardResultsBeforeDate(demo_res, discard_before_date)
+  return _CleanDemographicResults(
+      _DiscardResultsBeforeDate(demo_res, discard_before_date))
 
-  # Find responses that didn't use 'PLACEHOLDER' as the text for every question
-  filtered_results = [
-      r for r in filtered_results
-      if r['responses'][0]['question'] != 'PLACEHOLDER']
 
-  while(True):
-    try:
-      _ReorderAttributeQuestions(filtered_results, TECHFAMILIAR_QUESTION_PREFIX)
-      break
-    except BadlyFormattedEntryException as e:
-      # Warn about bad entry, but retry. A few of these are
-      # OK to ignore, but if there are a lot, someone should look into it.
-      logging.warning ('Bad entry found in _ReorderAttributeQuestions: '
-                       '%s Index: %d' % (e.value, e.entry_index))
-      filtered_results.pop(e.entry_index)
+def _CleanDemographicResults(demo_res, quarantine=None):
+  """Return demographic results that don't use 'PLACEHOLDER' as the text for
+    every question, with their techFamiliar questions arranged in canonical
+    (alphabetical) order.
+
+  Results whose techFamiliar questions aren't laid out like the others are
+  dropped with a warning. Every result is checked once, so many bad results
+  don't make this slower.
+
+  Args:
+    demo_res: Demographic results, already filtered by date
+    quarantine: Optional list; a (result, reason) tuple is appended to it
+      for each dropped result.
+
+  Returns:
+    (1) List of demographic results without PLACEHOLDER questions and with
+    techFamiliar questions reordered into canonical order.
+    (2) Integer index into the results list indicating which list
+    element's questions can be considered canonical and complete.
+  """
+  # Find responses that didn't use 'PLACEHOLDER' as the text for every question
+  placeholder_id = _InternQuestion('PLACEHOLDER')
+  filtered_results = [r for r in demo_res if r.questions[0] != placeholder_id]
+
+  filtered_results, bad_entries = _ValidateAttributeQuestions(
+      filtered_results, TECHFAMILIAR_QUESTION_PREFIX)
+  for r, reason in bad_entries:
+    # Warn about bad entry. A few of these are OK to ignore, but if there
+    # are a lot, someone should look into it.
+    logging.warning('Bad entry found in _ValidateAttributeQuestions: %s '
+                    'participant_id: %s' % (reason, r.participant_id))
+  if quarantine is not None:
+    quarantine.extend(bad_entries)
+  _ReorderAttributeQuestions(filtered_results, TECHFAMILIAR_QUESTION_PREFIX)
 
   return filtered_results, _GetCanonicalIndex(filtered_results)
 
@@ -139,16 +704,15 @@ def _FilterManufacturedEvents(results):
   that correspond to when the user was invited to take a survey.
 
   Args:
-    results: Results parsed from JSON. Assumed to already be filtered by date.
+    results: SurveyResults. Assumed to already be filtered by date.
 
   Returns:
     (1) List of results that are manufactured events.
     (2) Integer index into the results list indicating which list
     element's questions can be considered canonical and complete.
   """
-  manuf_events = [
-    r for r in results
-    if r['responses'][0]['question'] == 'MANUFACTURED']
+  manufactured_id = _InternQuestion('MANUFACTURED')
+  manuf_events = [r for r in results if r.questions[0] == manufactured_id]
 
   return manuf_events, _GetCanonicalIndex(manuf_events)
 
@@ -157,15 +721,36 @@ def _DiscardResultsBeforeDate(results, date):
   """Return a list of results that occur after the given date.
 
   Args:
-    results: Results parsed from a raw JSON file into list of dicts
+    results: List of SurveyResults
     date: A date of type datetime.datetime
 
   Returns:
     List of results whose date_taken value comes after the given date.
   """
-  return [
-      r for r in results
-      if dateutil.parser.parse(r['date_taken']) >= date]
+  date = _NormalizeTimestamp(date.isoformat())
+  return [r for r in results if r.taken >= date]
+
+
+def _NormalizeTimestamp(timestamp):
+  """Normalize a timestamp string for comparison with other timestamps.
+
+  Timestamps in the format written by the exporter only get their
+  microseconds padded, which is much faster than parsing them. Anything else
+  is parsed with dateutil and converted to UTC.
+
+  Args:
+    timestamp: A date and time string, e.g. '2015-01-05T11:48:39.760000'
+
+  Returns:
+    The timestamp as a 'YYYY-MM-DDTHH:MM:SS.ffffff' string. Strings in this
+    form sort in chronological order.
+  """
+  if ISO_TIMESTAMP_RE.match(timestamp):
+    return timestamp if len(timestamp) == 26 else timestamp + '.000000'
+  parsed = dateutil.parser.parse(timestamp)
+  if parsed.tzinfo is not None:
+    parsed = parsed.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None)
+  return parsed.strftime('%Y-%m-%dT%H:%M:%S.%f')
 
 
 def _FilterByCondition(cond, results):
@@ -174,7 +759,7 @@ def _FilterByCondition(cond, results):
   Args:
     cond: Condition to filter on; e.g., 'ssl-overridable-proceed',
       'malware-noproceed', etc.
-    results: Results parsed from raw JSON file into list of dicts
+    results: List of SurveyResults
 
   Returns:
     List of results for the given condition.
@@ -185,7 +770,7 @@ def _FilterByCondition(cond, results):
   if cond not in CONDITIONS:
     raise ValueError(cond + ' is not a valid condition')
 
-  return [pr for pr in results if pr['survey_type'] == cond + '.js']
+  return [pr for pr in results if pr.survey_type == cond + '.js']
 
 
 class QuestionError(BaseException):
@@ -206,13 +791,80 @@ class UnexpectedFormatException(BaseException):
 
 class BadlyFormattedEntryException(BaseException):
   def __init__(self, value, entry_index):
-    BaseException.__init__(self, value)
+    # Both arguments go in args, so the exception can be pickled.
+    BaseException.__init__(self, value, entry_index)
     self.value = value
     self.entry_index = entry_index
   def __str__(self):
     return(repr(self.value))
 
 
+class SurveyResult(object):
+  """One survey result, stored compactly.
+
+  Holds the metadata fields as given, the normalized date_taken, the
+  interned IDs of the questions and a flat list of answers, instead of the
+  nested dicts parsed from JSON.
+
+  Attributes:
+    date_received, date_taken, participant_id, survey_type: Metadata strings,
+        as they appear in the input and in the output CSV files.
+    taken: date_taken as returned by _NormalizeTimestamp, for comparisons.
+    questions: Array of question IDs, as returned by _InternQuestion.
+    answers: List of answers, in the same order as questions.
+  """
+  __slots__ = ('date_received', 'date_taken', 'participant_id', 'survey_type',
+               'taken', 'questions', 'answers')
+
+  def __init__(self, date_received, date_taken, participant_id, survey_type,
+               questions, answers):
+    self.date_received = date_received
+    self.date_taken = date_taken
+    self.participant_id = participant_id
+    self.survey_type = survey_type
+    self.taken = _NormalizeTimestamp(date_taken)
+    self.questions = array.array('i', questions)
+    self.answers = answers
+
+  @classmethod
+  def FromDict(cls, result):
+    """Build a SurveyResult from a result parsed from JSON."""
+    responses = result['responses']
+    return cls(result.get('date_received'), result['date_taken'],
+               result.get('participant_id'), result.get('survey_type'),
+               [_InternQuestion(qa_pair['question']) for qa_pair in responses],
+               [qa_pair['answer'] for qa_pair in responses])
+
+  def ToDict(self):
+    """Return the result in the form it was parsed from JSON."""
+    return {
+        'date_received': self.date_received,
+        'date_taken': self.date_taken,
+        'participant_id': self.participant_id,
+        'survey_type': self.survey_type,
+        'responses': [{'question': question, 'answer': answer}
+                      for question, answer in zip(self.QuestionTexts(),
+                                                  self.answers)]}
+
+  def Question(self, i):
+    """Return the text of question i."""
+    return _question_texts[self.questions[i]]
+
+  def QuestionTexts(self):
+    """Return the texts of all questions, in order."""
+    return [_question_texts[q] for q in self.questions]
+
+  # Question IDs are only meaningful in the process that assigned them, so
+  # results are pickled, e.g. for a process pool, with the question texts.
+  def __getstate__(self):
+    return self.ToDict()
+
+  def __setstate__(self, state):
+    result = SurveyResult.FromDict(state)
+    for name in self.__slots__:
+      setattr(self, name, getattr(result, name))
+
+
 def _CanonicalizeQuestions(results):
   """Apply various fixes to questions in results
 
@@ -237,9 +889,8 @@ def _CanonicalizeQuestions(results):
   in questions.
 
   Args:
-    results: List of results, where each result is a dict
-      containing metadata and response data from a survey response.
-      The results list should be filtered for one condition.
+    results: List of SurveyResults. The results list should be filtered
+      for one condition.
 
   Returns:
     (1) List of results fixed to canonicalize all questions
@@ -253,8 +904,8 @@ def _CanonicalizeQuestions(results):
         responses use PLACEHOLDER as the text for all questions
   """
   # Find responses that didn't use 'PLACEHOLDER' as the text for every question
-  fixed_results = [r for r in results
-                      if r['responses'][0]['question'] != 'PLACEHOLDER']
+  placeholder_id = _InternQuestion('PLACEHOLDER')
+  fixed_results = [r for r in results if r.questions[0] != placeholder_id]
   if not fixed_results:
     raise UnexpectedFormatException('No results with questions found')
 
@@ -272,21 +923,59 @@ def _CanonicalizeQuestions(results):
 
   # Do some light error checking; all questions lists should now be the same,
   # except some question lists may have extra questions. So, check each list
-  # of questions against the canonical list of questions.
-  for i, qa_pair in enumerate(
-      fixed_results[canonical_index]['responses']):
-    for j, r in enumerate(fixed_results):
-      if i < len(r['responses']):
-        if qa_pair['question'] != r['responses'][i]['question']:
-          raise QuestionError(
-              'Question text differs: Result %d question %d is {%s}. Result '
-              '%d question %d is {%s}.'
-              % (canonical_index, i, qa_pair['question'],
-                 j, i, r['responses'][i]['question']))
+  # of questions against the canonical list of questions. Each distinct
+  # schema only needs checking once.
+  canonical_schema = _QuestionSchema(fixed_results[canonical_index])
+  valid_schemas = set([canonical_schema])
+  mismatches = []
+  for j, r in enumerate(fixed_results):
+    schema = _QuestionSchema(r)
+    if schema in valid_schemas:
+      continue
+    if schema == canonical_schema[:len(schema)]:
+      valid_schemas.add(schema)
+      continue
+    i = next(i for i, (a, b) in enumerate(zip(schema, canonical_schema))
+             if a != b)
+    mismatches.append((i, j))
+  if mismatches:
+    # Report the first differing question, as a question-by-question scan
+    # of the results would.
+    i, j = min(mismatches)
+    raise QuestionError(
+        'Question text differs: Result %d question %d is {%s}. Result '
+        '%d question %d is {%s}.'
+        % (canonical_index, i, fixed_results[canonical_index].Question(i),
+           j, i, fixed_results[j].Question(i)))
 
   return fixed_results, canonical_index
 
 
+def _InternQuestion(text):
+  """Return the integer ID of a question text, assigning one if it's new."""
+  question_id = _question_ids.get(text)
+  if question_id is None:
+    question_id = _question_ids[text] = len(_question_texts)
+    _question_texts.append(text)
+  return question_id
+
+
+def _QuestionSchema(result):
+  """Return the questions of result as a tuple of question IDs
+
+  Two results ask the same questions in the same order iff their schemas
+  are equal, so schemas can be compared, hashed and cached instead of
+  comparing question texts.
+
+  Args:
+    result: A SurveyResult.
+
+  Returns:
+    Tuple of the question IDs of result, in order.
+  """
+  return tuple(result.questions)
+
+
 def _GetCanonicalIndex(filtered_results):
   """Get index of a result in filtered_results with max number of questions
 
@@ -300,16 +989,16 @@ def _GetCanonicalIndex(filtered_results):
   Returns:
     Index of some result with the longest list of q/a pairs
   """
-  max_list_len = len(filtered_results[0]['responses'])
+  max_list_len = len(filtered_results[0].questions)
   canonical_index = 0
   for i, r in enumerate(filtered_results):
-    if len(r['responses']) > max_list_len:
-      max_list_len = len(r['responses'])
+    if len(r.questions) > max_list_len:
+      max_list_len = len(r.questions)
       canonical_index = i
   return canonical_index
 
 
-def _WriteToCsv(results, canonical_index, out_file):
+def _WriteToCsv(results, canonical_index, out_file, append_header=None):
   """Write results for a given condition to a CSV file
 
   Given a list of results in the expected format, writes
@@ -318,43 +1007,382 @@ def _WriteToCsv(results, canonical_index, out_file):
   canonical_questions as column headers for corresponding answers.
 
   Args:
-    results: List of results, where each result is a dict
-        containing metadata and response data from a survey response.
-        The results list should be filtered for one condition, and
-        questions in the response data should be canonicalized.
+    results: List of SurveyResults. The results list should be filtered for
+        one condition, and their questions should be canonicalized.
     canonical_index: Index of element in results whose questions can
         be considered canonical for use as CSV column headers.
     out_file: CSV file to write output to.
+    append_header: If given, the header of the existing out_file. Results
+        are appended to it instead, as long as their header is the same or
+        a prefix of it; otherwise nothing is written.
+
+  Returns:
+    The header for results, as a list of column names. If it differs from
+    append_header, out_file was left unchanged.
+  """
+  canonical_questions = results[canonical_index].questions
+
+  field_names = list(METADATA_FIELDS)
+  field_names.extend(results[canonical_index].QuestionTexts())
+  if append_header is not None:
+    # Results without the optional trailing questions fit the existing
+    # columns and leave them empty.
+    if field_names != append_header[:len(field_names)]:
+      return field_names
+    canonical_questions = array.array('i', map(
+        _InternQuestion, append_header[len(METADATA_FIELDS):]))
+  with open(out_file, 'a' if append_header else 'w',
+            CSV_WRITE_BUFFER_SIZE) as csv_file:
+    csv_writer = csv.writer(csv_file)
+    if not append_header:
+      csv_writer.writerow(field_names)
+    # Rows are generated one at a time as the writer consumes them, so only
+    # one expanded row is held in memory at once.
+    csv_writer.writerows(_IterRows(results, canonical_questions, 'utf-8'))
+  return append_header or field_names
+
+
+def _WriteToSqlite(results, header, sqlite_file, table, append):
+  """Load results into a table of a SQLite database
+
+  The table has one TEXT column per entry in header, and indexes on the
+  fields in SQLITE_INDEXED_FIELDS. Rows are inserted in batches, in a single
+  transaction.
+
+  Args:
+    results: List of SurveyResults, as passed to _WriteToCsv.
+    header: Header returned by _WriteToCsv, used as the column names.
+    sqlite_file: SQLite database file; created if it doesn't exist.
+    table: Name of the table to write.
+    append: Whether to add to an existing table instead of replacing it.
+
+  Returns:
+    None.
+  """
+  canonical_questions = array.array('i', map(
+      _InternQuestion, header[len(METADATA_FIELDS):]))
+  columns = _SqliteColumns(header)
+  connection = sqlite3.connect(sqlite_file, timeout=SQLITE_TIMEOUT_SECONDS)
+  try:
+    with connection:
+      if not append:
+        connection.execute('DROP TABLE IF EXISTS %s' % _QuoteSqlite(table))
+      connection.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (
+          _QuoteSqlite(table),
+          ', '.join('%s TEXT' % _QuoteSqlite(c) for c in columns)))
+      insert = 'INSERT INTO %s VALUES (%s)' % (
+          _QuoteSqlite(table), ', '.join('?' * len(columns)))
+      rows = _IterRows(results, canonical_questions)
+      while True:
+        batch = list(itertools.islice(rows, SQLITE_BATCH_SIZE))
+        if not batch:
+          break
+        connection.executemany(insert, batch)
+      # Indexes are built after loading, which is faster than updating them
+      # for every row.
+      for field in SQLITE_INDEXED_FIELDS:
+        connection.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+            _QuoteSqlite(table + '_' + field), _QuoteSqlite(table),
+            _QuoteSqlite(field)))
+  finally:
+    connection.close()
+
+
+def _WriteColumnar(results, header, directory, append):
+  """Write results as columns, dictionary-encoding the repetitive ones
+
+  Most answers come from a small set of strings, so such a column is stored
+  as one small integer code per row plus a table of the distinct values the
+  codes stand for. Columns with a value for almost every row, like the
+  dates, participant IDs and URL answers, are stored plainly instead.
+  directory holds COLUMNAR_MANIFEST, a JSON object with:
+    rows: The number of rows.
+    columns: One object per entry in header, with the column 'name', its
+        'encoding' and the 'file' its rows are in. A 'dictionary' column
+        also has the 'values' the codes index into (null for missing
+        answers) and the NumPy 'dtype' of its codes; a 'plain' column has
+        the 'size' of its file in bytes.
+  A codes file is a little-endian array of unsigned integers, with the
+  narrowest type that fits the column's values, so it can be loaded with
+  array.fromfile or memory-mapped with numpy.memmap without parsing. A
+  'plain' column's file has one JSON value per line.
+
+  Args:
+    results: List of SurveyResults, as passed to _WriteToCsv.
+    header: Header returned by _WriteToCsv, used as the column names.
+    directory: Directory to write; created if it doesn't exist.
+    append: Whether to add to the existing columns in directory instead of
+      replacing them. New rows are appended to the column files in place;
+      a column is only rewritten if its codes need a wider type, or it has
+      too many values to stay dictionary-encoded.
+
+  Returns:
+    None.
+  """
+  manifest_file = os.path.join(directory, COLUMNAR_MANIFEST)
+  if append and os.path.exists(manifest_file):
+    with open(manifest_file, 'r') as f:
+      manifest = json.load(f)
+  else:
+    if os.path.isdir(directory):
+      shutil.rmtree(directory)
+    manifest = {'rows': 0, 'columns': None}
+
+  canonical_questions = array.array('i', map(
+      _InternQuestion, header[len(METADATA_FIELDS):]))
+  new_columns = [[] for _ in header]
+  for row in _IterRows(results, canonical_questions):
+    for value, column in zip(row, new_columns):
+      column.append(value)
+
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  if manifest['columns'] is None:
+    manifest['columns'] = []
+    for i, (name, new_values) in enumerate(zip(header, new_columns)):
+      if (i < len(METADATA_FIELDS) and
+          METADATA_FIELDS[i] in COLUMNAR_PLAIN_FIELDS or
+          not _IsLowCardinality(len(set(new_values)), len(new_values))):
+        column = {'name': name, 'encoding': 'plain', 'file': '%d.values' % i,
+                  'size': 0}
+      else:
+        typecode, dtype = COLUMNAR_CODE_TYPES[0]
+        column = {'name': name, 'encoding': 'dictionary',
+                  'file': _CodesFileName(i, typecode), 'values': [],
+                  'dtype': dtype}
+      manifest['columns'].append(column)
+  replaced = []
+  for column, new_values in zip(manifest['columns'], new_columns):
+    replaced.extend(_WriteColumnarColumn(directory, column, new_values,
+                                         manifest['rows']))
+  manifest['rows'] += len(results)
+  # Until the manifest is replaced, it still describes the columns as they
+  # were, so _TruncateColumnar can undo an append that didn't finish.
+  with open(manifest_file + '.tmp', 'w') as f:
+    json.dump(manifest, f)
+  os.rename(manifest_file + '.tmp', manifest_file)
+  for name in replaced:
+    os.remove(os.path.join(directory, name))
+
+
+def _IsLowCardinality(distinct_values, rows):
+  """Return whether a column is worth dictionary-encoding."""
+  return distinct_values <= COLUMNAR_MAX_DICTIONARY_VALUES and (
+      distinct_values <= COLUMNAR_SMALL_DICTIONARY or
+      distinct_values * 2 <= rows)
+
+
+def _WriteColumnarColumn(directory, column, new_values, old_rows):
+  """Append new_values to a column written by _WriteColumnar
+
+  Args:
+    directory: Directory written by _WriteColumnar.
+    column: The column's object in the manifest; updated in place.
+    new_values: List of the values to append, one per new row.
+    old_rows: Number of rows already in the column.
+
+  Returns:
+    List of the files the column was moved out of. A column that has to be
+    rewritten is written to a new file, so the old one is still intact
+    until the manifest is updated, and only then removed.
+  """
+  path = os.path.join(directory, column['file'])
+  index = int(column['file'].split('.')[0])
+  if column['encoding'] == 'plain':
+    with open(path, 'ab' if old_rows else 'wb') as f:
+      for value in new_values:
+        f.write(json.dumps(value) + '\n')
+      column['size'] = f.tell()
+    return []
+
+  values = column['values']
+  encoder = dict((value, code) for code, value in enumerate(values))
+  codes = []
+  for value in new_values:
+    code = encoder.get(value)
+    if code is None:
+      code = encoder[value] = len(values)
+      values.append(value)
+    codes.append(code)
+
+  if len(values) > COLUMNAR_MAX_DICTIONARY_VALUES:
+    # Too many distinct values; store the whole column plainly instead.
+    old_codes = _ReadCodes(path, column['dtype'], old_rows)
+    replaced = column['file']
+    del column['values'], column['dtype']
+    column['encoding'] = 'plain'
+    column['file'] = '%d.values' % index
+    _WriteColumnarColumn(directory, column,
+                         [values[code] for code in old_codes] + new_values, 0)
+    return [replaced]
+
+  typecode, dtype = next(
+      (typecode, dtype) for typecode, dtype in COLUMNAR_CODE_TYPES
+      if len(values) <= 1 << (8 * array.array(typecode).itemsize))
+  replaced = []
+  if old_rows and dtype != column['dtype']:
+    # The codes need a wider type, so rewrite the existing ones too.
+    codes = list(_ReadCodes(path, column['dtype'], old_rows)) + codes
+    old_rows = 0
+    replaced.append(column['file'])
+    column['file'] = _CodesFileName(index, typecode)
+    path = os.path.join(directory, column['file'])
+  column['dtype'] = dtype
+  codes = array.array(typecode, codes)
+  if sys.byteorder == 'big':
+    codes.byteswap()
+  with open(path, 'ab' if old_rows else 'wb') as f:
+    codes.tofile(f)
+  return replaced
+
+
+def _CodesFileName(index, typecode):
+  """Return the name of the codes file of column index with typecode."""
+  return '%d.u%d.codes' % (index, array.array(typecode).itemsize)
+
+
+def _TruncateColumnar(directory, rows):
+  """Cut columns written by _WriteColumnar back to their first rows rows
+
+  Also drops anything an unfinished append left after the rows in the
+  manifest. A plain column is only scanned if rows is less than the rows in
+  the manifest.
+
+  Args:
+    directory: Directory written by _WriteColumnar.
+    rows: Number of rows to keep.
 
   Returns:
     None.
   """
-  canonical_questions = [
-      qa_pair['question']
-      for qa_pair in results[canonical_index]['responses']]
+  manifest_file = os.path.join(directory, COLUMNAR_MANIFEST)
+  if not os.path.exists(manifest_file):
+    return
+  with open(manifest_file, 'r') as f:
+    manifest = json.load(f)
+  rows = min(rows, manifest['rows'])
+  item_sizes = dict((dtype, array.array(typecode).itemsize)
+                    for typecode, dtype in COLUMNAR_CODE_TYPES)
+  for column in manifest['columns']:
+    path = os.path.join(directory, column['file'])
+    if column['encoding'] == 'dictionary':
+      size = rows * item_sizes[column['dtype']]
+    elif rows == manifest['rows']:
+      size = column['size']
+    else:
+      with open(path, 'rb') as f:
+        for _ in xrange(rows):
+          f.readline()
+        size = column['size'] = f.tell()
+    _TruncateFile(path, size)
+  if rows != manifest['rows']:
+    manifest['rows'] = rows
+    with open(manifest_file + '.tmp', 'w') as f:
+      json.dump(manifest, f)
+    os.rename(manifest_file + '.tmp', manifest_file)
+
+
+def _TruncateFile(path, size):
+  """Truncate the file at path to size bytes, if it exists and is longer."""
+  if os.path.exists(path) and os.path.getsize(path) > size:
+    with open(path, 'r+b') as f:
+      f.truncate(size)
+
+
+def _ReadCodes(path, dtype, rows):
+  """Read rows codes of the given dtype from a codes file."""
+  typecode = dict((dtype, typecode)
+                  for typecode, dtype in COLUMNAR_CODE_TYPES)[dtype]
+  codes = array.array(typecode)
+  with open(path, 'rb') as f:
+    codes.fromfile(f, rows)
+  if sys.byteorder == 'big':
+    codes.byteswap()
+  return codes
+
+
+def _ReadColumnar(directory):
+  """Read columns written by _WriteColumnar
+
+  Args:
+    directory: Directory written by _WriteColumnar.
+
+  Returns:
+    (1) List of the column names
+    (2) List of (values, codes) tuples, one per column. For a dictionary
+    column, codes is an array of indices into the list values. For a plain
+    column, values is None and codes is the list of the column's values.
+  """
+  with open(os.path.join(directory, COLUMNAR_MANIFEST), 'r') as f:
+    manifest = json.load(f)
+  names = []
+  columns = []
+  for column in manifest['columns']:
+    path = os.path.join(directory, column['file'])
+    if column['encoding'] == 'plain':
+      with open(path, 'r') as f:
+        columns.append((None, [json.loads(line) for line in f]))
+    else:
+      columns.append((column['values'],
+                      _ReadCodes(path, column['dtype'], manifest['rows'])))
+    names.append(column['name'])
+  return names, columns
+
+
+def _SqliteColumns(header):
+  """Return unique SQLite column names for a CSV header
+
+  SQLite column names are case insensitive and must be unique, so repeated
+  names get a numeric suffix.
+  """
+  columns = []
+  seen = set()
+  for name in header:
+    column = name
+    n = 2
+    while column.lower() in seen:
+      column = '%s (%d)' % (name, n)
+      n += 1
+    seen.add(column.lower())
+    columns.append(column)
+  return columns
+
+
+def _QuoteSqlite(identifier):
+  """Quote a table, column or index name for use in SQLite statements."""
+  return '"%s"' % identifier.replace('"', '""')
 
-  # Use the Python csv library to write to csv format. Our input data
-  # had survey questions and answers grouped under the 'responses' key, but we
-  # want to expand the 'responses' into question/answer pairs, so
-  # that each question gets its own column in the output CSV file. So, we put
-  # the data in the desired form, open the CSV file, and write it out.
-  results_for_csv_writer = []
+
+def _IterRows(results, canonical_questions, encoding=None):
+  """Generate output rows for results, in the column order of field_names
+
+  Each row has the metadata fields followed by one column per canonical
+  question. Results whose questions are already in canonical order, which
+  is the usual case after canonicalization, take their answers
+  positionally. Others are matched up by question, and questions they lack
+  are None, which the csv module writes as an empty field.
+
+  Args:
+    results: List of SurveyResults, as passed to _WriteToCsv.
+    canonical_questions: Array of the IDs of the questions used as column
+        headers.
+    encoding: If given, answers are encoded with it, as the csv module
+        needs.
+
+  Yields:
+    A list of values for each result.
+  """
   for r in results:
-    dict_for_csv_writer = {}
-    for qa_pair in r['responses']:
-      dict_for_csv_writer[qa_pair['question']] = (
-          qa_pair['answer'].encode('utf-8'))
-    dict_for_csv_writer.update(r)
-    del dict_for_csv_writer['responses']
-    results_for_csv_writer.append(dict_for_csv_writer)
-
-  field_names = ['date_received', 'date_taken', 'participant_id',
-      'survey_type']
-  field_names.extend(canonical_questions)
-  with open(out_file, 'w') as csv_file:
-    csv_writer = csv.DictWriter(csv_file, field_names)
-    csv_writer.writeheader()
-    csv_writer.writerows(results_for_csv_writer)
+    row = [r.date_received, r.date_taken, r.participant_id, r.survey_type]
+    answers = r.answers
+    if encoding:
+      answers = [answer.encode(encoding) for answer in answers]
+    if r.questions == canonical_questions:
+      row.extend(answers)
+    else:
+      answers = dict(zip(r.questions, answers))
+      row.extend(answers.get(question) for question in canonical_questions)
+    yield row
 
 
 def _ReorderAttributeQuestions(results, question_prefix):
@@ -367,7 +1395,7 @@ def _ReorderAttributeQuestions(results, question_prefix):
   as canonical order.
 
   Args:
-    results: A list of dicts containing parsed and filtered results.
+    results: A list of SurveyResults, parsed and filtered.
         It is assumed that results has been filtered for a given survey
         condition, such that attributes questions should all appear in the
         same place.
@@ -382,14 +1410,10 @@ def _ReorderAttributeQuestions(results, question_prefix):
     UnexpectedFormatException: Something unexpected found in input.
   """
   # Gather a list of lists of the indices of the attribute questions in
-  # each result
-  attribute_question_indices = []
-  for r in results:
-    index_list = []
-    for i, qa_pair in enumerate(r['responses']):
-      if question_prefix in qa_pair['question']:
-        index_list.append(i)
-    attribute_question_indices.append(index_list)
+  # each result, along with the order that sorts them. Both only depend on
+  # the questions, so they are worked out once per schema.
+  layouts = [_AttributeLayout(r, question_prefix) for r in results]
+  attribute_question_indices = [index_list for index_list, _ in layouts]
 
   # Do some error checking; attribute questions should have the same indices
   # for all results and should appear consecutively. Since they should be the
@@ -408,14 +1432,75 @@ def _ReorderAttributeQuestions(results, question_prefix):
       raise BadlyFormattedEntryException(
           'indices in list %d not consecutive' % i, i)
 
-  for r in results:
-    r['responses'][min_index:max_index+1] = sorted(
-        r['responses'][min_index:max_index+1],
-        key=lambda x: x['question'])
+  for r, (_, order) in zip(results, layouts):
+    r.questions[min_index:max_index+1] = array.array(
+        'i', [r.questions[i] for i in order])
+    r.answers[min_index:max_index+1] = [r.answers[i] for i in order]
 
   return results
 
 
+def _AttributeLayout(result, question_prefix):
+  """Find the attribute questions in result
+
+  Only depends on the questions, so it is worked out once per schema.
+
+  Args:
+    result: A SurveyResult.
+    question_prefix: A string that uniquely defines the attribute questions.
+
+  Returns:
+    (1) List of the indices of the attribute questions in result
+    (2) The same indices, in the order that sorts their questions
+  """
+  key = (question_prefix, _QuestionSchema(result))
+  layout = _attribute_layouts.get(key)
+  if layout is None:
+    texts = result.QuestionTexts()
+    index_list = [i for i, question in enumerate(texts)
+                  if question_prefix in question]
+    order = sorted(index_list, key=lambda i: texts[i])
+    layout = _attribute_layouts[key] = (index_list, order)
+  return layout
+
+
+def _ValidateAttributeQuestions(results, question_prefix):
+  """Split results by whether their attribute questions are well formed
+
+  Checks each result once against the layout _ReorderAttributeQuestions
+  expects: attribute questions that appear consecutively, at the same
+  indices as in the first such result.
+
+  Args:
+    results: A list of SurveyResults, parsed and filtered.
+        It is assumed that results has been filtered for a given survey
+        condition, such that attributes questions should all appear in the
+        same place.
+    question_prefix: A string that uniquely defines the attribute questions.
+
+  Returns:
+    (1) List of the well formed results, in their original order
+    (2) List of (result, reason) tuples for the other results
+  """
+  good = []
+  bad = []
+  expected = None
+  for r in results:
+    index_list, _ = _AttributeLayout(r, question_prefix)
+    if not index_list:
+      bad.append((r, 'attribute questions not found'))
+    elif index_list != range(index_list[0], index_list[-1] + 1):
+      bad.append((r, 'attribute question indices not consecutive'))
+    elif expected is not None and index_list != expected:
+      bad.append((r, 'attribute question indices %d to %d not equal to %d '
+                  'to %d in the first entry' % (index_list[0], index_list[-1],
+                                                expected[0], expected[-1])))
+    else:
+      expected = index_list
+      good.append(r)
+  return good, bad
+
+
 def _ReplaceUrlWithPlaceholder(results):
   """Fix a bug by replacing domain names with placeholders
 
@@ -428,7 +1513,7 @@ def _ReplaceUrlWithPlaceholder(results):
   do the replacement in the first question in each result.
 
   Args:
-    results:  A list of dicts containing parsed and filtered results.
+    results: A list of SurveyResults, parsed and filtered.
         Is it assumed that results has been filtered for a given survey
         condition, such that attributes questions should all appear in the
         same place.
@@ -437,13 +1522,17 @@ def _ReplaceUrlWithPlaceholder(results):
     The fixed results. Changes the input results list as well.
   """
   for r in results:
-    q = r['responses'][0]['question'] # Do replacement in first question only
-    chosenMatch = re.search('\"Proceed to.*?\"', q)
-    alternateMatch = re.search('\"Back to safety\.\"', q)
-    if chosenMatch:
-      q = q.replace(chosenMatch.group(0), '\"[CHOSEN]\"')
-    if alternateMatch:
-      q = q.replace(alternateMatch.group(0), '\"[ALTERNATIVE].\"')
-    r['responses'][0]['question'] = q
+    q = r.questions[0] # Do replacement in first question only
+    fixed = _placeholder_questions.get(q)
+    if fixed is None:
+      text = _question_texts[q]
+      chosenMatch = CHOSEN_RE.search(text)
+      alternateMatch = ALTERNATIVE_RE.search(text)
+      if chosenMatch:
+        text = text.replace(chosenMatch.group(0), '\"[CHOSEN]\"')
+      if alternateMatch:
+        text = text.replace(alternateMatch.group(0), '\"[ALTERNATIVE].\"')
+      fixed = _placeholder_questions[q] = _InternQuestion(text)
+    r.questions[0] = fixed
 
   return results
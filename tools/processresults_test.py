@@ -1,14 +1,22 @@
 """Unit tests for processing CUES results from raw JSON to CSV
 
 Run on command line with: python processresults_test.py
-Should print 9 exceptions (these are expected output from ProcessResults)
-and pass 11 tests.
+Should print 162 exceptions (these are expected output from ProcessResults)
+and pass 31 tests.
 """
 
+import copy
+import csv
 import datetime
+import glob
+import gzip
 import json
 import processresults
 import os
+import pickle
+import shutil
+import sqlite3
+import time
 import unittest
 
 class TestProcessResults(unittest.TestCase):
@@ -16,6 +24,8 @@ class TestProcessResults(unittest.TestCase):
   def setUp(self):
     with open('processresults_test_input.json', 'r') as json_file:
       self.mock_results = json.load(json_file)
+    self.records = [processresults.SurveyResult.FromDict(r)
+                    for r in self.mock_results]
 
   def test_ProcessResults_creates_three_csv_files_with_expected_data(self):
     processresults.ProcessResults('processresults_test_input.json',
@@ -74,70 +84,469 @@ class TestProcessResults(unittest.TestCase):
       self.assertIn('P4A1,P4A2,P4A3,P4AttributeAAnswer,'
                     'P4AttributeBAnswer,P4AttributeCAnswer,P4A7', test_line)
 
+  def test_ProcessResults_writes_quarantine_file_only_for_bad_entries(self):
+    bad = copy.deepcopy(self.mock_results)
+    bad.append(copy.deepcopy(bad[6]))
+    bad[-1]['responses'] = bad[-1]['responses'][:2]
+    with open('processresults_test_bad.json', 'w') as json_file:
+      json.dump(bad, json_file)
+    try:
+      for json_in_file, quarantined in (
+          ('processresults_test_bad.json', 1),
+          ('processresults_test_input.json', 0)):
+        processresults.ProcessResults(json_in_file, 'processresults_test_',
+                                      processresults.DOGFOOD_START_DATE,
+                                      processresults.DEMOGRAPHIC_STABLE_DATE)
+        quarantine_file = 'processresults_test_demographics-quarantine.json'
+        if quarantined:
+          with open(quarantine_file) as f:
+            self.assertEqual(quarantined, len(f.readlines()))
+        else:
+          self.assertFalse(os.path.exists(quarantine_file))
+    finally:
+      os.remove('processresults_test_bad.json')
+
+  def test_ProcessResults_with_workers_matches_single_process_output(self):
+    outputs = ['demographics', 'manufactured', 'ssl-overridable-proceed',
+               'malware-noproceed']
+    for prefix, workers in (('processresults_test_', 1),
+                            ('processresults_test_pool_', 2)):
+      processresults.ProcessResults('processresults_test_input.json', prefix,
+                                    processresults.DOGFOOD_START_DATE,
+                                    processresults.DEMOGRAPHIC_STABLE_DATE,
+                                    workers=workers)
+    for output in outputs:
+      with open('processresults_test_%s.csv' % output) as single:
+        with open('processresults_test_pool_%s.csv' % output) as pooled:
+          self.assertEqual(single.read(), pooled.read())
+      os.remove('processresults_test_pool_%s.csv' % output)
+
+  def test_ProcessResults_with_workers_is_not_slower_than_single_process(self):
+    # Large enough that shipping results to the workers would dominate.
+    with open('processresults_test_large.json', 'w') as json_file:
+      json.dump(self.mock_results * 3000, json_file)
+    try:
+      elapsed = {}
+      for workers in (1, 2, 1, 2):
+        start = time.time()
+        processresults.ProcessResults('processresults_test_large.json',
+                                      'processresults_test_large_',
+                                      processresults.DOGFOOD_START_DATE,
+                                      processresults.DEMOGRAPHIC_STABLE_DATE,
+                                      workers=workers)
+        elapsed[workers] = min(elapsed.get(workers, float('inf')),
+                               time.time() - start)
+      # Allow for the cost of starting the pool and for timing noise.
+      self.assertLess(elapsed[2], elapsed[1] * 1.2 + 0.1)
+    finally:
+      os.remove('processresults_test_large.json')
+      for output in glob.glob('processresults_test_large_*'):
+        os.remove(output)
+
+  def test_ProcessResults_with_workers_raises_on_nonequal_questions(self):
+    mismatched = copy.deepcopy(self.mock_results)
+    mismatched[2]['responses'][1]['question'] = 'A different question'
+    with open('processresults_test_mismatched.json', 'w') as json_file:
+      json.dump(mismatched, json_file)
+    try:
+      for workers in (1, 2):
+        self.assertRaises(processresults.QuestionError,
+                          processresults.ProcessResults,
+                          'processresults_test_mismatched.json',
+                          'processresults_test_mismatched_',
+                          processresults.DOGFOOD_START_DATE,
+                          processresults.DEMOGRAPHIC_STABLE_DATE,
+                          workers=workers)
+    finally:
+      os.remove('processresults_test_mismatched.json')
+      for output in glob.glob('processresults_test_mismatched_*'):
+        os.remove(output)
+
+  def test_ProcessResults_incremental_run_matches_full_run(self):
+    outputs = ['demographics', 'manufactured', 'ssl-overridable-proceed',
+               'malware-noproceed']
+    earlier = [r for r in self.mock_results
+               if r['date_received'] < '2015-01-06']
+    with open('processresults_test_earlier.json', 'w') as json_file:
+      json.dump(earlier, json_file)
+    delta = [r for r in self.mock_results
+             if r['date_received'] >= '2015-01-06']
+    with open('processresults_test_delta.json', 'w') as json_file:
+      json.dump(delta, json_file)
+    # The first run only sees the earlier results. The second only reads the
+    # delta: it appends the new ssl-overridable-proceed result, and rebuilds
+    # malware-noproceed, which had no results to write before, from the full
+    # export.
+    processresults.ProcessResults('processresults_test_earlier.json',
+                                  'processresults_test_inc_',
+                                  processresults.DOGFOOD_START_DATE,
+                                  processresults.DEMOGRAPHIC_STABLE_DATE,
+                                  state_file='processresults_test_state')
+    processresults.ProcessResults(['processresults_test_delta.json'],
+                                  'processresults_test_inc_',
+                                  processresults.DOGFOOD_START_DATE,
+                                  processresults.DEMOGRAPHIC_STABLE_DATE,
+                                  state_file='processresults_test_state',
+                                  full_export_file=
+                                      'processresults_test_input.json')
+    processresults.ProcessResults('processresults_test_input.json',
+                                  'processresults_test_',
+                                  processresults.DOGFOOD_START_DATE,
+                                  processresults.DEMOGRAPHIC_STABLE_DATE)
+    for output in outputs:
+      with open('processresults_test_%s.csv' % output) as full:
+        with open('processresults_test_inc_%s.csv' % output) as incremental:
+          self.assertEqual(full.read(), incremental.read())
+      os.remove('processresults_test_inc_%s.csv' % output)
+    with open('processresults_test_state') as state_file:
+      self.assertEqual('2015-01-12T00:01:02.345678',
+                       json.load(state_file)['last_date_received'])
+    os.remove('processresults_test_earlier.json')
+    os.remove('processresults_test_delta.json')
+    os.remove('processresults_test_state')
+
+  def test_ProcessResults_failed_incremental_run_does_not_duplicate_rows(self):
+    earlier = [r for r in self.mock_results
+               if r['date_received'] < '2015-01-06']
+    with open('processresults_test_earlier.json', 'w') as json_file:
+      json.dump(earlier, json_file)
+    delta = [r for r in self.mock_results
+             if r['date_received'] >= '2015-01-06']
+    delta.append(copy.deepcopy(self.mock_results[8]))
+    delta[-1]['date_received'] = '2015-01-12T00:01:02.345678'
+    mismatched = copy.deepcopy(delta[0])
+    mismatched['responses'][1]['question'] = 'A different question'
+    with open('processresults_test_delta.json', 'w') as json_file:
+      json.dump(delta + [mismatched], json_file)
+    try:
+      processresults.ProcessResults('processresults_test_earlier.json',
+                                    'processresults_test_inc_',
+                                    processresults.DOGFOOD_START_DATE,
+                                    processresults.DEMOGRAPHIC_STABLE_DATE,
+                                    state_file='processresults_test_state',
+                                    sqlite_file='processresults_test.sqlite',
+                                    columnar=True)
+      # The new manufactured event is written by the first failing run, and
+      # not again by the second.
+      for _ in range(2):
+        self.assertRaises(processresults.QuestionError,
+                          processresults.ProcessResults,
+                          'processresults_test_delta.json',
+                          'processresults_test_inc_',
+                          processresults.DOGFOOD_START_DATE,
+                          processresults.DEMOGRAPHIC_STABLE_DATE,
+                          state_file='processresults_test_state',
+                          sqlite_file='processresults_test.sqlite',
+                          columnar=True)
+        with open('processresults_test_inc_manufactured.csv') as csv_file:
+          self.assertEqual(4, len(csv_file.readlines()))
+        with open('processresults_test_state') as state_file:
+          self.assertEqual('2015-01-05T13:14:15.345678',
+                           json.load(state_file)['last_date_received'])
+      with open('processresults_test_delta.json', 'w') as json_file:
+        json.dump(delta, json_file)
+      processresults.ProcessResults('processresults_test_delta.json',
+                                    'processresults_test_inc_',
+                                    processresults.DOGFOOD_START_DATE,
+                                    processresults.DEMOGRAPHIC_STABLE_DATE,
+                                    state_file='processresults_test_state',
+                                    sqlite_file='processresults_test.sqlite',
+                                    columnar=True,
+                                    full_export_file=
+                                        'processresults_test_input.json')
+      connection = sqlite3.connect('processresults_test.sqlite')
+      try:
+        for output, rows in (('manufactured', 3),
+                             ('ssl-overridable-proceed', 2)):
+          with open('processresults_test_inc_%s.csv' % output) as csv_file:
+            self.assertEqual(rows + 1, len(csv_file.readlines()))
+          self.assertEqual([(rows,)], connection.execute(
+              'SELECT COUNT(*) FROM "%s"' % output).fetchall())
+          names, columns = processresults._ReadColumnar(
+              'processresults_test_inc_%s.columns' % output)
+          self.assertEqual(rows, len(columns[0][1]))
+      finally:
+        connection.close()
+    finally:
+      os.remove('processresults_test_earlier.json')
+      os.remove('processresults_test_delta.json')
+      os.remove('processresults_test_state')
+      os.remove('processresults_test.sqlite')
+      for output in glob.glob('processresults_test_inc_*'):
+        if os.path.isdir(output):
+          shutil.rmtree(output)
+        else:
+          os.remove(output)
+
+  def test_ProcessResults_skips_rebuild_without_full_export(self):
+    earlier = [r for r in self.mock_results
+               if r['date_received'] < '2015-01-06']
+    with open('processresults_test_earlier.json', 'w') as json_file:
+      json.dump(earlier, json_file)
+    delta = [copy.deepcopy(self.mock_results[2])]
+    delta[0]['responses'].extend([
+        {'question': 'URL', 'answer': 'www.example.com'},
+        {'question': 'Q9', 'answer': 'P3A9'}])
+    with open('processresults_test_delta.json', 'w') as json_file:
+      json.dump(delta, json_file)
+    with open('processresults_test_full.json', 'w') as json_file:
+      json.dump(earlier + delta, json_file)
+    try:
+      processresults.ProcessResults('processresults_test_earlier.json',
+                                    'processresults_test_inc_',
+                                    processresults.DOGFOOD_START_DATE,
+                                    processresults.DEMOGRAPHIC_STABLE_DATE,
+                                    state_file='processresults_test_state')
+      with open('processresults_test_inc_ssl-overridable-proceed.csv') as f:
+        before = f.read()
+      # The new question changes the header, so the output can't be rebuilt
+      # from the delta alone, and is left as it was.
+      processresults.ProcessResults('processresults_test_delta.json',
+                                    'processresults_test_inc_',
+                                    processresults.DOGFOOD_START_DATE,
+                                    processresults.DEMOGRAPHIC_STABLE_DATE,
+                                    state_file='processresults_test_state')
+      with open('processresults_test_inc_ssl-overridable-proceed.csv') as f:
+        self.assertEqual(before, f.read())
+      with open('processresults_test_state') as state_file:
+        self.assertEqual('2015-01-05T13:14:15.345678',
+                         json.load(state_file)['last_date_received'])
+      processresults.ProcessResults('processresults_test_delta.json',
+                                    'processresults_test_inc_',
+                                    processresults.DOGFOOD_START_DATE,
+                                    processresults.DEMOGRAPHIC_STABLE_DATE,
+                                    state_file='processresults_test_state',
+                                    full_export_file=
+                                        'processresults_test_full.json')
+      with open('processresults_test_inc_ssl-overridable-proceed.csv') as f:
+        rows = list(csv.reader(f))
+      self.assertEqual('Q9', rows[0][-1])
+      self.assertEqual(3, len(rows))
+      with open('processresults_test_state') as state_file:
+        self.assertEqual('2015-01-12T00:01:02.345678',
+                         json.load(state_file)['last_date_received'])
+    finally:
+      for output in (glob.glob('processresults_test_inc_*') +
+                     ['processresults_test_earlier.json',
+                      'processresults_test_delta.json',
+                      'processresults_test_full.json',
+                      'processresults_test_state']):
+        os.remove(output)
+
+  def test_ProcessResults_loads_outputs_into_sqlite(self):
+    processresults.ProcessResults('processresults_test_input.json',
+                                  'processresults_test_',
+                                  processresults.DOGFOOD_START_DATE,
+                                  processresults.DEMOGRAPHIC_STABLE_DATE,
+                                  sqlite_file='processresults_test.sqlite')
+    connection = sqlite3.connect('processresults_test.sqlite')
+    try:
+      self.assertEqual(
+          [(2,)], connection.execute(
+              'SELECT COUNT(*) FROM "ssl-overridable-proceed"').fetchall())
+      self.assertEqual(
+          [(u'2015-01-05T01:02:03.789123',)], connection.execute(
+              'SELECT date_taken FROM demographics WHERE participant_id = ?',
+              (self.mock_results[6]['participant_id'],)).fetchall())
+      indexes = [row[0] for row in connection.execute(
+          'SELECT name FROM sqlite_master WHERE type = "index"')]
+      self.assertIn('manufactured_date_taken', indexes)
+    finally:
+      connection.close()
+      os.remove('processresults_test.sqlite')
+
+  def test_ProcessResults_columnar_output_decodes_to_csv_rows(self):
+    processresults.ProcessResults('processresults_test_input.json',
+                                  'processresults_test_',
+                                  processresults.DOGFOOD_START_DATE,
+                                  processresults.DEMOGRAPHIC_STABLE_DATE,
+                                  columnar=True)
+    for output in ['demographics', 'manufactured', 'ssl-overridable-proceed',
+                   'malware-noproceed']:
+      directory = 'processresults_test_%s.columns' % output
+      names, columns = processresults._ReadColumnar(directory)
+      rows = [[(codes[i] if values is None else values[codes[i]] or u''
+               ).encode('utf-8') for values, codes in columns]
+              for i in range(len(columns[0][1]))]
+      with open('processresults_test_%s.csv' % output) as csv_file:
+        csv_rows = list(csv.reader(csv_file))
+      self.assertEqual(csv_rows[0], [n.encode('utf-8') for n in names])
+      self.assertEqual(csv_rows[1:], rows)
+      shutil.rmtree(directory)
+
+  def test__WriteColumnarColumn_appends_and_widens_codes(self):
+    directory = 'processresults_test_column.columns'
+    os.mkdir(directory)
+    try:
+      column = {'name': 'q', 'encoding': 'dictionary',
+                'file': '0.u1.codes', 'values': [], 'dtype': '<u1'}
+      processresults._WriteColumnarColumn(directory, column,
+                                          [u'a', None, u'a'], 0)
+      self.assertEqual([], processresults._WriteColumnarColumn(
+          directory, column, [None, u'b'], 3))
+      self.assertEqual('<u1', column['dtype'])
+      self.assertEqual(5, os.path.getsize(
+          os.path.join(directory, '0.u1.codes')))
+      many = [unicode(i) for i in range(300)]
+      # The wider codes go to a new file; the old one is left for the caller
+      # to remove once the manifest points at the new one.
+      self.assertEqual(['0.u1.codes'], processresults._WriteColumnarColumn(
+          directory, column, many, 5))
+      self.assertEqual('<u2', column['dtype'])
+      self.assertEqual('0.u2.codes', column['file'])
+      codes = processresults._ReadCodes(
+          os.path.join(directory, '0.u2.codes'), column['dtype'], 305)
+      self.assertEqual([u'a', None, u'a', None, u'b'] + many,
+                       [column['values'][code] for code in codes])
+    finally:
+      shutil.rmtree(directory)
+
+  def test_SurveyResult_round_trips_through_dict_and_pickle(self):
+    for r, record in zip(self.mock_results, self.records):
+      self.assertEqual(r, record.ToDict())
+      unpickled = pickle.loads(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+      self.assertEqual(record.questions, unpickled.questions)
+      self.assertEqual(record.answers, unpickled.answers)
+
+  def test__TrackDateReceived_skips_raw_results_already_processed(self):
+    state = {'last_date_received': None}
+    results = list(processresults._TrackDateReceived(
+        iter(self.mock_results), '2015-01-05T13:14:15.234567', state))
+
+    self.assertEqual([self.mock_results[i] for i in (2, 3, 7)], results)
+    self.assertEqual('2015-01-12T00:01:02.345678',
+                     state['last_date_received'])
+
+  def test__IterRows_matches_reordered_and_missing_questions(self):
+    base = {'date_received': '2015-01-01T00:00:00', 'date_taken': '2015',
+            'participant_id': 'p', 'survey_type': 'setup.js'}
+    in_order = processresults.SurveyResult.FromDict(dict(
+        base, responses=[{'question': 'Q1', 'answer': u'a'},
+                         {'question': 'Q2', 'answer': u'b'}]))
+    shuffled = processresults.SurveyResult.FromDict(dict(
+        base, responses=[{'question': 'Q2', 'answer': u'c'}]))
+    rows = list(processresults._IterRows([in_order, shuffled],
+                                            in_order.questions))
+    self.assertEqual(['2015-01-01T00:00:00', '2015', 'p', 'setup.js', 'a', 'b'],
+                     rows[0])
+    self.assertEqual(['2015-01-01T00:00:00', '2015', 'p', 'setup.js', None,
+                      'c'],
+                     rows[1])
+
+  def test__IterSurveyResults_reads_json_array_across_chunks(self):
+    chunk_size = processresults.JSON_READ_CHUNK_SIZE
+    processresults.JSON_READ_CHUNK_SIZE = 7
+    try:
+      results = list(processresults._IterSurveyResults(
+          'processresults_test_input.json'))
+    finally:
+      processresults.JSON_READ_CHUNK_SIZE = chunk_size
+
+    self.assertEqual(results, self.mock_results)
+
+  def test__IterSurveyResults_reads_gzipped_ndjson(self):
+    ndjson_file = 'processresults_test_input.ndjson.gz'
+    with gzip.open(ndjson_file, 'wb') as f:
+      for r in self.mock_results:
+        f.write(json.dumps(r) + '\n')
+    try:
+      results = list(processresults._IterSurveyResults(ndjson_file))
+    finally:
+      os.remove(ndjson_file)
+
+    self.assertEqual(results, self.mock_results)
+
+  def test__PartitionResults_routes_results_in_one_pass(self):
+    demo, manuf, by_condition = processresults._PartitionResults(
+        iter(self.records), processresults.DOGFOOD_START_DATE,
+        processresults.DEMOGRAPHIC_STABLE_DATE)
+
+    self.assertEqual(len(demo), 1)
+    self.assertEqual(demo[0].date_taken, u'2015-01-05T01:02:03.789123')
+    self.assertEqual(len(manuf), 2)
+    self.assertEqual(sorted(by_condition.keys()),
+                     sorted(processresults.CONDITIONS))
+    self.assertEqual(len(by_condition['ssl-overridable-proceed']), 2)
+    self.assertEqual(len(by_condition['malware-noproceed']), 1)
+    self.assertEqual(by_condition['phishing-proceed'], [])
+
   def test__DiscardResultsBeforeDate_filters_out_two_november_dates(self):
     results = [
-        r for r in self.mock_results
-        if (r['survey_type'] != 'setup.js' and
-            r['responses'][0]['question'] != 'MANUFACTURED')]
+        r for r in self.records
+        if (r.survey_type != 'setup.js' and
+            r.Question(0) != 'MANUFACTURED')]
     results = processresults._DiscardResultsBeforeDate(
         results, datetime.datetime(2014, 12, 01, 0, 0, 0, 0))
 
     self.assertEqual(len(results), 3)
-    self.assertEqual(results[0]['date_taken'], u'2015-01-05T11:48:39.760000')
-    self.assertEqual(results[1]['date_taken'], u'2015-01-05T00:00:00.123456')
-    self.assertEqual(results[2]['date_taken'], u'2015-01-05T01:02:03.123456')
+    self.assertEqual(results[0].date_taken, u'2015-01-05T11:48:39.760000')
+    self.assertEqual(results[1].date_taken, u'2015-01-05T00:00:00.123456')
+    self.assertEqual(results[2].date_taken, u'2015-01-05T01:02:03.123456')
+
+  def test__NormalizeTimestamp_pads_exported_timestamps(self):
+    self.assertEqual(
+        processresults._NormalizeTimestamp(u'2015-01-05T11:48:39.760000'),
+        u'2015-01-05T11:48:39.760000')
+    self.assertEqual(
+        processresults._NormalizeTimestamp('2014-12-01T00:00:00'),
+        '2014-12-01T00:00:00.000000')
+
+  def test__NormalizeTimestamp_falls_back_to_dateutil(self):
+    self.assertEqual(
+        processresults._NormalizeTimestamp('2015-01-05 03:48:39-08:00'),
+        '2015-01-05T11:48:39.000000')
 
   def test__FilterByCondition_filters_out_two_malware_noproceed(self):
-    results = self.mock_results
+    results = self.records
     results = processresults._FilterByCondition('ssl-overridable-proceed',
                                                 results)
 
     self.assertEqual(len(results), 3)
-    self.assertEqual(results[0]['survey_type'], 'ssl-overridable-proceed.js')
-    self.assertEqual(results[1]['survey_type'], 'ssl-overridable-proceed.js')
-    self.assertEqual(results[2]['survey_type'], 'ssl-overridable-proceed.js')
+    self.assertEqual(results[0].survey_type, 'ssl-overridable-proceed.js')
+    self.assertEqual(results[1].survey_type, 'ssl-overridable-proceed.js')
+    self.assertEqual(results[2].survey_type, 'ssl-overridable-proceed.js')
 
   def test__CanonicalizeQuestions_filters_out_placeholder_questions(self):
-    results = [r for r in self.mock_results
-               if r['survey_type'] == 'malware-noproceed.js']
+    results = [r for r in self.records
+               if r.survey_type == 'malware-noproceed.js']
     results, canonical_index = processresults._CanonicalizeQuestions(results)
 
     self.assertEqual(len(results), 1)
-    self.assertNotEqual(results[0]['responses'][0]['question'], 'PLACEHOLDER')
+    self.assertNotEqual(results[0].Question(0), 'PLACEHOLDER')
 
   def test__CanonicalizeQuestions_reorders_attribute_questions(self):
-    results = [r for r in self.mock_results
-               if r['survey_type'] == 'ssl-overridable-proceed.js']
+    results = [r for r in self.records
+               if r.survey_type == 'ssl-overridable-proceed.js']
     processresults._CanonicalizeQuestions(results)
 
     self.assertEqual(len(results), 3)
     for r in results:
       self.assertEqual(
-          r['responses'][3]['question'],
+          r.Question(3),
           ('To what degree do each of the following adjectives '
           'describe this page?(A)'))
       self.assertEqual(
-          r['responses'][4]['question'],
+          r.Question(4),
           ('To what degree do each of the following adjectives '
           'describe this page?(B)'))
       self.assertEqual(
-          r['responses'][5]['question'],
+          r.Question(5),
           ('To what degree do each of the following adjectives '
           'describe this page?(C)'))
 
   def test__CanonicalizeQuestions_replaces_urls_with_placeholder(self):
-    results = [r for r in self.mock_results
-               if r['survey_type'] == 'ssl-overridable-proceed.js']
+    results = [r for r in self.records
+               if r.survey_type == 'ssl-overridable-proceed.js']
     processresults._CanonicalizeQuestions(results)
 
     for r in results:
       self.assertEqual(
-          r['responses'][0]['question'],
+          r.Question(0),
           'blah "[CHOSEN]" "[ALTERNATIVE]." blah')
 
   def test__CanonicalizeQuestions_returns_canonical_index(self):
-    results = [r for r in self.mock_results
-               if r['survey_type'] == 'ssl-overridable-proceed.js']
+    results = [r for r in self.records
+               if r.survey_type == 'ssl-overridable-proceed.js']
     results, canonical_index = processresults._CanonicalizeQuestions(results)
 
     # 2nd item (index 1) in mock_results should be selected as canonical
@@ -145,40 +554,74 @@ class TestProcessResults(unittest.TestCase):
 
   def test__CanonicalizeQuestions_raises_exception_on_nonequal_questions(self):
     results = [
-        r for r in self.mock_results
-        if (r['survey_type'] != 'setup.js' and
-            r['responses'][0]['question'] != 'MANUFACTURED')]
+        r for r in self.records
+        if (r.survey_type != 'setup.js' and
+            r.Question(0) != 'MANUFACTURED')]
     self.assertRaises(processresults.QuestionError,
                       processresults._CanonicalizeQuestions, results)
 
+  def test__QuestionSchema_is_equal_for_equal_question_lists(self):
+    responses = [{'question': 'Q1', 'answer': 'a'},
+                 {'question': u'Q2', 'answer': 'b'}]
+    same = [{'question': u'Q1', 'answer': 'c'},
+            {'question': 'Q2', 'answer': 'd'}]
+    results = [
+        processresults.SurveyResult.FromDict(
+            {'date_taken': '2015-01-05T00:00:00', 'responses': r})
+        for r in (responses, same, same[::-1])]
+    self.assertEqual(processresults._QuestionSchema(results[0]),
+                     processresults._QuestionSchema(results[1]))
+    self.assertNotEqual(processresults._QuestionSchema(results[0]),
+                        processresults._QuestionSchema(results[2]))
+
   def test__FilterDemographicResults_filters_out_december_5th_date(self):
-    results = [r for r in self.mock_results
-               if r['survey_type'] == 'setup.js']
+    results = [r for r in self.records
+               if r.survey_type == 'setup.js']
     results, canonical_index = processresults._FilterDemographicResults(
         results, datetime.datetime(2014, 12, 18, 0, 0, 0, 0))
 
     self.assertEqual(len(results), 1)
-    self.assertEqual(results[0]['date_taken'], u'2015-01-05T01:02:03.789123')
+    self.assertEqual(results[0].date_taken, u'2015-01-05T01:02:03.789123')
 
   def test__FilterDemographicResults_reorders_techfamiliar_questions(self):
-    results = [r for r in self.mock_results
-               if r['survey_type'] == 'setup.js']
+    results = [r for r in self.records
+               if r.survey_type == 'setup.js']
     results, canonical_index = processresults._FilterDemographicResults(
         results, datetime.datetime(2014, 12, 18, 0, 0, 0, 0))
 
     self.assertEqual(len(results), 1)
     self.assertEqual(
-        results[0]['responses'][2]['question'],
+        results[0].Question(2),
         ('How familiar are you with each of the following computer and '
          'Internet-related items? I have...(DendoPort)'))
     self.assertEqual(
-        results[0]['responses'][3]['question'],
+        results[0].Question(3),
         ('How familiar are you with each of the following computer and '
          'Internet-related items? I have...(TCP/IP)'))
 
+  def test__CleanDemographicResults_quarantines_bad_entries(self):
+    good = [r for r in self.mock_results if r['survey_type'] == 'setup.js'][1]
+    split = copy.deepcopy(good)
+    split['responses'][1], split['responses'][2] = (
+        split['responses'][2], split['responses'][1])
+    missing = copy.deepcopy(good)
+    missing['responses'] = missing['responses'][:2]
+    good, split, good_again, missing = [
+        processresults.SurveyResult.FromDict(r)
+        for r in (good, split, good, missing)]
+    quarantine = []
+    results, canonical_index = processresults._CleanDemographicResults(
+        [good, split, good_again, missing], quarantine)
+
+    self.assertEqual(len(results), 2)
+    self.assertEqual(
+        [(split, 'attribute question indices not consecutive'),
+         (missing, 'attribute questions not found')],
+        quarantine)
+
   def test__FilterManufacturedEvents_returns_correct_events_and_index(self):
-    results = [r for r in self.mock_results
-               if r['survey_type'] != 'setup.js']
+    results = [r for r in self.records
+               if r.survey_type != 'setup.js']
     results = processresults._DiscardResultsBeforeDate(
         results, datetime.datetime(2014, 12, 01, 0, 0, 0, 0))
     results, canonical_index = processresults._FilterManufacturedEvents(results)
@@ -187,11 +630,15 @@ class TestProcessResults(unittest.TestCase):
     self.assertEqual(canonical_index, 1)
 
   def tearDown(self):
-    try:
-      os.remove('processresults_test_ssl-overridable-proceed.csv')
-      os.remove('processresults_test_malware-noproceed.csv')
-    except OSError:
-      pass
+    for output in ('ssl-overridable-proceed', 'malware-noproceed',
+                   'demographics', 'manufactured'):
+      try:
+        os.remove('processresults_test_%s.csv' % output)
+      except OSError:
+        pass
+    for quarantine_file in glob.glob('processresults_test_*' +
+                                     processresults.QUARANTINE_SUFFIX):
+      os.remove(quarantine_file)
 
 if __name__ == '__main__':
   unittest.main()